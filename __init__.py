@@ -18,6 +18,7 @@ from .wsjobd import (
     InvalidProgressError,
     LoadingError,
     JobNotInSessionError,
+    process_job,
 )
 
 __all__ = [
@@ -30,4 +31,5 @@ __all__ = [
     "InvalidProgressError",
     "LoadingError",
     "JobNotInSessionError",
+    "process_job",
 ]
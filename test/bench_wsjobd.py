@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark wsjobd with concurrent clients.
+
+It starts a wsjobd server in a sub process, and runs every scenario with `--clients` clients, each of them submits a
+job of `test_jobs/test_job_bench.py` and reads progress until the job is done. The result of a scenario is printed
+as one json line, and appended to `--output`:
+
+- `start_latency`: p50, p90, p99 and max seconds from a job message sent to its first progress frame received.
+- `frames_per_sec`: progress frames received by all clients per second.
+- `cpu_sec_per_conn`, `rss_bytes_per_conn`: cpu time and rss growth of the server divided by the number of clients.
+- `max_threads`: the max number of threads of the server.
+
+Usage:
+
+    python test/bench_wsjobd.py --clients 200 --output bench_output.txt
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+import websocket
+
+this_base = os.path.dirname(os.path.abspath(__file__))
+
+JOBS_DIR = "k3wsjobd/test/test_jobs"
+
+SERVER_SCRIPT = """
+import k3wsjobd
+k3wsjobd.run(ip="127.0.0.1", port=%d, jobq_thread_count=%d, preload_jobs_dirs=[%r])
+"""
+
+# name -> (job description fields, the time a client sleeps after every frame, all clients share one ident)
+SCENARIOS = {
+    "shared_ident": ({}, 0, True),
+    "distinct_idents": ({}, 0, False),
+    "slow_consumers": ({}, 0.05, False),
+    "report_system_load": ({"report_system_load": True}, 0, False),
+    "large_payload": ({"payload_size": 64 * 1024}, 0, False),
+}
+
+
+def start_server(port, jobq_thread_count):
+    env = dict(os.environ, PYTHONPATH=os.path.join(this_base, "..", ".."))
+    proc = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SCRIPT % (port, jobq_thread_count, JOBS_DIR)],
+        env=env,
+    )
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+
+    proc.kill()
+    raise RuntimeError("wsjobd server is not started")
+
+
+class ServerMonitor(object):
+    def __init__(self, pid, interval=0.05):
+        self.proc = psutil.Process(pid)
+        self.interval = interval
+        self.max_rss = 0
+        self.max_threads = 0
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        self.cpu = self._cpu()
+        self.rss = self.proc.memory_info().rss
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.cpu = self._cpu() - self.cpu
+
+    def _cpu(self):
+        t = self.proc.cpu_times()
+        return t.user + t.system
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.max_rss = max(self.max_rss, self.proc.memory_info().rss)
+            self.max_threads = max(self.max_threads, self.proc.num_threads())
+
+
+def run_client(port, desc, read_delay, result):
+    ws = websocket.WebSocket()
+    ws.connect("ws://127.0.0.1:%d" % port)
+    ws.timeout = 60
+
+    try:
+        t0 = time.monotonic()
+        ws.send(json.dumps(desc))
+
+        frames = 0
+        while True:
+            frame = json.loads(ws.recv())
+            if frames == 0:
+                result["start_latency"] = time.monotonic() - t0
+
+            if "err" in frame:
+                result["err"] = frame["err"]
+                break
+
+            if frame.get("status") == "done":
+                break
+
+            frames += 1
+            if read_delay > 0:
+                time.sleep(read_delay)
+
+        result["frames"] = frames
+    except Exception as e:
+        result["err"] = repr(e)
+    finally:
+        ws.close()
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_scenario(name, port, server, n_clients, n_updates):
+    fields, read_delay, shared = SCENARIOS[name]
+
+    results = [{} for _ in range(n_clients)]
+    threads = []
+
+    with ServerMonitor(server.pid) as monitor:
+        t0 = time.monotonic()
+
+        for i, result in enumerate(results):
+            desc = {
+                "func": "test_job_bench.run",
+                "ident": "bench_%s_%d_%s" % (name, os.getpid(), "shared" if shared else i),
+                "jobs_dir": JOBS_DIR,
+                "n_updates": n_updates,
+                "progress": {"interval": 1, "max_rate": 100},
+            }
+            desc.update(fields)
+
+            th = threading.Thread(target=run_client, args=(port, desc, read_delay, result), daemon=True)
+            th.start()
+            threads.append(th)
+
+        for th in threads:
+            th.join()
+
+        duration = time.monotonic() - t0
+
+    latencies = [r["start_latency"] for r in results if "start_latency" in r]
+    frames = sum(r.get("frames", 0) for r in results)
+
+    return {
+        "scenario": name,
+        "clients": n_clients,
+        "errors": sum(1 for r in results if "err" in r),
+        "duration_sec": duration,
+        "start_latency": {
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else None,
+        },
+        "frames": frames,
+        "frames_per_sec": frames / duration,
+        "cpu_sec_per_conn": monitor.cpu / n_clients,
+        "rss_bytes_per_conn": max(0, monitor.max_rss - monitor.rss) / n_clients,
+        "max_threads": monitor.max_threads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark wsjobd")
+    parser.add_argument("--clients", type=int, default=100, help="the number of concurrent clients")
+    parser.add_argument("--updates", type=int, default=20, help="the number of progress updates of every job")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="default: all scenarios")
+    parser.add_argument("--port", type=int, default=33455)
+    parser.add_argument("--jobq-threads", type=int, default=20)
+    parser.add_argument("--output", help="the file to append results to")
+    args = parser.parse_args()
+
+    meta = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+    server = start_server(args.port, args.jobq_threads)
+    try:
+        for name in args.scenario or list(SCENARIOS):
+            result = dict(meta)
+            result.update(run_scenario(name, args.port, server, args.clients, args.updates))
+
+            line = json.dumps(result, sort_keys=True)
+            print(line)
+            sys.stdout.flush()
+
+            if args.output is not None:
+                with open(args.output, "a") as f:
+                    f.write(line + "\n")
+    finally:
+        server.kill()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def run(job):
+    data = job.data
+
+    for i in range(3):
+        data["n"] = i
+        await asyncio.sleep(0.1)
+
+    data["result"] = "foo"
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+
+
+def run(job):
+    data = job.data
+
+    data["payload"] = "x" * data.get("payload_size", 0)
+
+    for i in range(data.get("n_updates", 20)):
+        data["i"] = i
+        job.update()
+        time.sleep(data.get("update_interval", 0.01))
+
+    data["result"] = "done"
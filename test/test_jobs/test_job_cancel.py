@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+
+
+def run(job):
+    for i in range(100):
+        if job.cancelled.is_set():
+            return
+
+        job.data["n"] = i
+        time.sleep(0.1)
+
+    job.data["result"] = "foo"
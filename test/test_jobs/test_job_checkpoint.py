@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+
+
+def run(job):
+    data = job.data
+    data["restored"] = job.restored
+
+    for i in range(job.restored or 0, 20):
+        data["n"] = i
+        job.checkpoint(i)
+        time.sleep(0.3)
+
+    data["result"] = "foo"
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import time
+
+
+def run(job):
+    data = job.data
+
+    data["pid"] = os.getpid()
+    for i in range(5):
+        data["n"] = i
+        time.sleep(0.2)
+
+    data["result"] = "foo"
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import logging
+import os
+import time
+
+import k3wsjobd
+
+logger = logging.getLogger(__name__)
+
+
+@k3wsjobd.process_job
+def run(job):
+    data = job.data
+
+    data["pid"] = os.getpid()
+
+    for i in range(5):
+        data["n"] = i
+        time.sleep(0.1)
+
+    data["result"] = "foo"
@@ -1,18 +1,35 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import asyncio
 import os
+import queue
 import random
+import subprocess
+import shutil
+import signal
+import sys
+import tempfile
+import threading
 import time
 import unittest
+import urllib.request
+import zlib
+from unittest import mock
 
+import gevent
+import gevent.socket
+import msgpack
 import websocket
 
 import k3proc
 import k3utfjson
 import k3ut
+import k3wsjobd
 from k3wsjobd import Job
+from k3wsjobd.test.wsjobd_server import METRICS_PORT
 from k3wsjobd.test.wsjobd_server import PORT
+from k3wsjobd.test.wsjobd_server import TRACE_FILE
 
 dd = k3ut.dd
 
@@ -91,6 +108,18 @@ class TestWsjobd(unittest.TestCase):
             self.assertIn("err", resp, desc)
             ws.close()
 
+        for priority in (0, 1.5, 11, "1"):
+            ws = self._create_client()
+            ws.send(k3utfjson.dump({"ident": "foo", "func": "test_job_normal.run", "priority": priority}))
+            resp = k3utfjson.load(ws.recv())
+            self.assertEqual("InvalidMessageError", resp["err"], priority)
+            ws.close()
+
+    def test_binary_jobdesc(self):
+        self.ws.send_binary(b'{"cmd": "submit"}')
+        resp = k3utfjson.load(self.ws.recv())
+        self.assertEqual("InvalidMessageError", resp["err"])
+
     def test_normal_job(self):
         job_desc = {
             "func": "test_job_normal.run",
@@ -129,6 +158,21 @@ class TestWsjobd(unittest.TestCase):
         # tolerate 0.1 second of difference
         self.assertLess(diff, 0.1)
 
+    def test_invalid_interval(self):
+        for interval in ("5", None, 0, -1, True):
+            job_desc = {
+                "func": "test_job_normal.run",
+                "ident": self.get_random_ident(),
+                "progress": {"interval": interval},
+                "jobs_dir": "k3wsjobd/test/test_jobs",
+            }
+
+            ws = self._create_client()
+            ws.send(k3utfjson.dump(job_desc))
+            resp = k3utfjson.load(ws.recv())
+            self.assertEqual("InvalidProgressError", resp["err"], interval)
+            ws.close()
+
     def test_invalid_progress_key(self):
         job_desc = {
             "func": "test_job_progress_key.run",
@@ -280,7 +324,7 @@ class TestWsjobd(unittest.TestCase):
 
         self.ws.send(k3utfjson.dump(job_desc))
 
-        resp = k3utfjson.load(self.ws.recv())
+        resp = self._wait_for_result(self.ws)
         self.assertEqual("foo", resp["result"])
 
         job_desc = {
@@ -361,6 +405,249 @@ class TestWsjobd(unittest.TestCase):
         resp = k3utfjson.load(resp)
         self.assertEqual("foo", resp["result"])
 
+    def test_delta_progress(self):
+        job_desc = {
+            "func": "test_job_loop_10.run",
+            "ident": self.get_random_ident(),
+            "progress": {
+                "interval": 0.3,
+                "delta": True,
+            },
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+        }
+
+        self.ws.send(k3utfjson.dump(job_desc))
+
+        resp = k3utfjson.load(self.ws.recv())
+        self.assertEqual(job_desc["ident"], resp["snapshot"]["ident"])
+
+        resp = k3utfjson.load(self.ws.recv())
+        self.assertNotIn("ident", resp["patch"])
+
+        self.ws.send(k3utfjson.dump({"cmd": "resync"}))
+
+        resp = k3utfjson.load(self.ws.recv())
+        self.assertEqual(job_desc["ident"], resp["snapshot"]["ident"])
+
+    def test_process_job(self):
+        job_desc = {
+            "func": "test_job_process.run",
+            "ident": self.get_random_ident(),
+            "progress": {
+                "interval": 0.1,
+            },
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+        }
+
+        self.ws.send(k3utfjson.dump(job_desc))
+
+        ns = set()
+        for _ in range(100):
+            resp = k3utfjson.load(self.ws.recv())
+            ns.add(resp.get("n"))
+            if "result" in resp:
+                break
+
+        self.assertEqual("foo", resp["result"])
+        self.assertNotEqual(os.getpid(), resp["pid"])
+        # progress is reported while the job is running in another process
+        self.assertGreater(len(ns - set([None])), 1)
+
+    def test_cancel(self):
+        # a thread job and a process job
+        for process in (False, True):
+            job_desc = {
+                "func": "test_job_cancel.run",
+                "ident": self.get_random_ident(),
+                "process": process,
+                "progress": {
+                    "interval": 0.1,
+                },
+                "jobs_dir": "k3wsjobd/test/test_jobs",
+            }
+
+            ws = self._create_client()
+            ws.send(k3utfjson.dump(job_desc))
+            k3utfjson.load(ws.recv())
+
+            ws.send(k3utfjson.dump({"cmd": "cancel"}))
+
+            frames = []
+            while True:
+                frame = ws.recv()
+                if not frame:
+                    break
+                frames.append(k3utfjson.load(frame))
+            ws.close()
+
+            self.assertEqual({"status": "cancelled"}, frames[-1], process)
+            self.assertNotIn("result", frames[-2])
+            self.assertLess(frames[-2].get("n", 0), 50)
+
+    def test_coroutine_job(self):
+        job_desc = {
+            "func": "test_job_async.run",
+            "ident": self.get_random_ident(),
+            "progress": {
+                "interval": 0.1,
+            },
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+        }
+
+        self.ws.send(k3utfjson.dump(job_desc))
+
+        for _ in range(100):
+            resp = k3utfjson.load(self.ws.recv())
+            if "result" in resp:
+                break
+
+        self.assertEqual("foo", resp["result"])
+        self.assertEqual(2, resp["n"])
+
+    def test_multiplex(self):
+        idents = [self.get_random_ident() for _ in range(3)]
+        self.ws.send(k3utfjson.dump({"multiplex": True}))
+
+        for ident in idents:
+            job_desc = {
+                "cmd": "submit",
+                "func": "test_job_echo.run",
+                "ident": ident,
+                "echo": ident,
+                "sleep_time": 0.5,
+                "progress": {"interval": 0.1},
+                "jobs_dir": "k3wsjobd/test/test_jobs",
+            }
+            self.ws.send(k3utfjson.dump(job_desc))
+
+        self.ws.send(k3utfjson.dump({"cmd": "submit", "ident": "foo", "func": "foo.bar"}))
+
+        # another connection subscribes to a job it did not create
+        ws2 = self._create_client()
+        time.sleep(0.1)
+        ws2.send(k3utfjson.dump({"multiplex": True}))
+        ws2.send(k3utfjson.dump({"cmd": "subscribe", "ident": idents[0], "progress": {"interval": 0.1}}))
+        ws2.send(k3utfjson.dump({"cmd": "subscribe", "ident": "inexistent"}))
+
+        errs = {}
+        ended = {}
+        while len(ended) < len(idents):
+            resp = k3utfjson.load(self.ws.recv())
+            frame = resp["frame"]
+            if "err" in frame:
+                errs[resp["ident"]] = frame["err"]
+            elif "status" in frame:
+                ended[resp["ident"]] = frame["status"]
+            else:
+                self.assertEqual(resp["ident"], frame["echo"])
+
+        self.assertEqual({"foo": "LoadingError"}, errs)
+        self.assertEqual(dict((ident, "done") for ident in idents), ended)
+
+        frames = []
+        while True:
+            resp = k3utfjson.load(ws2.recv())
+            frames.append(resp)
+            if "status" in resp["frame"] and resp["ident"] == idents[0]:
+                break
+
+        self.assertIn(
+            {
+                "ident": "inexistent",
+                "frame": {"err": "JobNotInSessionError", "val": ["job not in sessions: 'inexistent'"]},
+            },
+            frames,
+        )
+        frames = [f["frame"] for f in frames if f["ident"] == idents[0]]
+        self.assertEqual(idents[0], frames[0]["echo"])
+
+        # connection is still open after all jobs end
+        self.ws.send(k3utfjson.dump({"cmd": "unknown"}))
+        resp = k3utfjson.load(self.ws.recv())
+        self.assertEqual("InvalidMessageError", resp["frame"]["err"])
+        ws2.close()
+
+    def test_multiplex_unsubscribe(self):
+        ident = self.get_random_ident()
+        job_desc = {
+            "cmd": "submit",
+            "func": "test_job_loop_10.run",
+            "ident": ident,
+            "progress": {"interval": 0.1},
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+        }
+        self.ws.send(k3utfjson.dump({"multiplex": True}))
+        self.ws.send(k3utfjson.dump(job_desc))
+        resp = k3utfjson.load(self.ws.recv())
+        self.assertEqual(ident, resp["ident"])
+
+        self.ws.send(k3utfjson.dump({"cmd": "unsubscribe", "ident": ident}))
+        time.sleep(0.2)
+
+        self.ws.timeout = 0.5
+        with self.assertRaises(websocket.WebSocketTimeoutException):
+            for _ in range(10):
+                self.ws.recv()
+
+    def test_cmd_in_job_desc(self):
+        # only the hello switches to multiplex mode, a job can have a `cmd` argument
+        job_desc = {
+            "cmd": "submit",
+            "multiplex": True,
+            "func": "test_job_echo.run",
+            "ident": self.get_random_ident(),
+            "echo": "foo",
+            "sleep_time": 0.1,
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+        }
+        self.ws.send(k3utfjson.dump(job_desc))
+
+        resp = self._wait_for_result(self.ws)
+        self.assertEqual("foo", resp["result"])
+
+    def test_batch(self):
+        idents = [self.get_random_ident() for _ in range(20)]
+        job_desc = {
+            "batch": [
+                {"func": "test_job_echo.run", "ident": ident, "echo": ident, "sleep_time": 0.2} for ident in idents
+            ],
+            "progress": {"interval": 0.1},
+            "report_system_load": True,
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+        }
+
+        self.ws.send(k3utfjson.dump(job_desc))
+
+        frames = []
+        for _ in range(100):
+            frames.append(k3utfjson.load(self.ws.recv()))
+            if "status" in frames[-1]:
+                break
+
+        self.assertIn("mem_available", frames[0]["system_load"])
+        self.assertEqual(set(idents), set(frames[-2]["batch"].keys()))
+        for ident in idents:
+            self.assertEqual(ident, frames[-2]["batch"][ident]["result"])
+
+        self.assertEqual("done", frames[-1]["status"])
+        self.assertEqual(dict((ident, {"status": "done"}) for ident in idents), frames[-1]["batch"])
+
+    def test_invalid_batch(self):
+        cases = (
+            {"batch": "foo"},
+            {"batch": []},
+            {"batch": [{"ident": "foo"}]},
+            {"batch": [{"ident": "foo", "func": "foo.bar"}], "jobs_dir": "k3wsjobd/test/test_jobs"},
+        )
+
+        for case in cases:
+            ws = self._create_client()
+            ws.send(k3utfjson.dump(case))
+
+            resp = k3utfjson.load(ws.recv())
+            ws.close()
+            self.assertIn("err", resp, case)
+
     def test_invalid_cpu_sample_interval(self):
         job_desc = {
             "func": "test_job_normal.run",
@@ -416,21 +703,103 @@ class TestWsjobd(unittest.TestCase):
             "func": "test_job_worker_exception.run",
             "ident": ident,
             "jobs_dir": "k3wsjobd/test/test_jobs",
-            "progress": {
-                "interval": 0.1,
-            },
         }
 
+        t0 = time.time()
         self.ws.send(k3utfjson.dump(job_desc))
 
-        for i in range(10):
-            resp = self.ws.recv()
+        for i in range(3):
+            resp = k3utfjson.load(self.ws.recv())
+            if "status" in resp:
+                break
             self.assertNotIn("err", resp)
 
+        # the terminal frame is sent at once, not after the 5 seconds interval
+        self.assertLess(time.time() - t0, 1)
+        self.assertEqual("error", resp["status"])
+        self.assertEqual("IndexError", resp["err"])
+
+        # the connection is closed
         with self.assertRaises(Exception):
             for i in range(3):
                 self.ws.recv()
 
+    def test_terminal_frame(self):
+        job_desc = {
+            "func": "test_job_normal.run",
+            "ident": self.get_random_ident(),
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+        }
+
+        t0 = time.time()
+        self.ws.send(k3utfjson.dump(job_desc))
+
+        frames = []
+        for i in range(3):
+            frames.append(k3utfjson.load(self.ws.recv()))
+            if "status" in frames[-1]:
+                break
+
+        self.assertLess(time.time() - t0, 1)
+        self.assertEqual("foo", frames[-2]["result"])
+        self.assertEqual({"status": "done"}, frames[-1])
+
+        # the connection is closed
+        with self.assertRaises(Exception):
+            for i in range(3):
+                self.ws.recv()
+
+    def test_metrics(self):
+        job_desc = {
+            "func": "test_job_echo.run",
+            "ident": self.get_random_ident(),
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+            "echo": "hello",
+        }
+        self.ws.send(k3utfjson.dump(job_desc))
+        self._wait_for_result(self.ws)
+
+        ws = self._create_client()
+        ws.send(k3utfjson.dump({"ident": "x"}))
+        self.assertEqual("InvalidMessageError", k3utfjson.load(ws.recv())["err"])
+        ws.close()
+
+        resp = urllib.request.urlopen("http://127.0.0.1:%d/metrics" % METRICS_PORT, timeout=3)
+        text = resp.read().decode("utf-8")
+
+        self.assertIn("\nwsjobd_clients ", text)
+        self.assertIn("\nwsjobd_jobq_depth 0\n", text)
+        self.assertIn('\nwsjobd_errors_total{err="InvalidMessageError"} ', text)
+        self.assertIn('\nwsjobd_errors_total{err="LoadingError"} ', text)
+        self.assertIn('\nwsjobd_job_duration_seconds_count{func="test_job_echo.run"} ', text)
+        self.assertIn("\nwsjobd_frame_bytes_count ", text)
+        self.assertIn('\nwsjobd_encode_seconds_count{codec="json"} ', text)
+
+    def test_trace(self):
+        ident = self.get_random_ident()
+        job_desc = {
+            "func": "test_job_echo.run",
+            "ident": ident,
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+            "check_load": {},
+            "trace": True,
+        }
+        self.ws.send(k3utfjson.dump(job_desc))
+        self._wait_for_result(self.ws)
+        time.sleep(0.1)
+
+        with open(TRACE_FILE) as f:
+            traces = [k3utfjson.load(line) for line in f]
+        trace = [t for t in traces if t["ident"] == ident][0]
+
+        names = [s["name"] for s in trace["spans"]]
+        self.assertEqual(
+            sorted(["jobq", "parse", "check_load", "func_lookup", "thread_start", "first_send"]), sorted(names)
+        )
+        for span in trace["spans"]:
+            self.assertLessEqual(trace["received"], span["start"])
+            self.assertLessEqual(span["start"], span["end"])
+
     def test_create_job(self):
         self.assertEqual(0, len(Job.sessions))
 
@@ -470,3 +839,1349 @@ class TestWsjobd(unittest.TestCase):
         Job("channel", {"ident": "a"}, f)
         joba2 = Job.sessions["a"]
         self.assertNotEqual(joba1, joba2)
+
+
+class FakeWebSocket(object):
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def send(self, msg):
+        self.sent.append(k3utfjson.load(msg))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeChannel(object):
+    def __init__(self, ws=None):
+        self.ws = ws or FakeWebSocket()
+        self.multiplex = False
+        self.subscriptions = []
+        self.outbox = k3wsjobd.wsjobd.ChannelOutbox(self)
+
+
+class RawWebSocket(FakeWebSocket):
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class StuckWebSocket(FakeWebSocket):
+    def send(self, msg):
+        gevent.sleep(10)
+
+
+class TestProgressScheduler(unittest.TestCase):
+    def test_single_scheduler_for_many_channels(self):
+        def f(job):
+            job.data["n"] = 1
+            time.sleep(0.3)
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "scheduler"}, f)
+        n_threads = threading.active_count()
+
+        channels = [FakeChannel() for _ in range(200)]
+        for ch in channels:
+            sub = k3wsjobd.wsjobd.ProgressSubscription(job, ch, interval=0.05, max_rate=1000)
+            k3wsjobd.wsjobd.progress_scheduler.add(sub)
+
+        gevent.sleep(0.2)
+
+        self.assertLessEqual(threading.active_count(), n_threads)
+        for ch in channels:
+            self.assertGreaterEqual(len(ch.ws.sent), 3)
+            self.assertEqual(1, ch.ws.sent[-1]["n"])
+
+        # wake all subscriptions at once
+        for ch in channels:
+            ch.ws.sent = []
+        job.progress_available.set()
+        for _ in range(4):
+            gevent.sleep(0.01)
+            if all(ch.ws.sent for ch in channels):
+                break
+        for ch in channels:
+            self.assertEqual(1, len(ch.ws.sent))
+
+        # wait for job to quit and all subscriptions to finish
+        gevent.sleep(0.8)
+        for ch in channels:
+            self.assertTrue(ch.ws.closed)
+        self.assertEqual([], job.subscriptions)
+        self.assertEqual(0, len(Job.sessions))
+
+    def test_broken_subscription(self):
+        def f(job):
+            job.data["n"] = 1
+            time.sleep(0.3)
+
+        scheduler = k3wsjobd.wsjobd.progress_scheduler
+        scheduler.start()
+
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "broken_sub"}, f)
+
+        broken = k3wsjobd.wsjobd.ProgressSubscription(job, FakeChannel(), interval="5")
+        ch = FakeChannel()
+        sub = k3wsjobd.wsjobd.ProgressSubscription(job, ch, interval=0.05, max_rate=1000)
+        scheduler.add(broken)
+        scheduler.add(sub)
+
+        gevent.sleep(0.2)
+
+        self.assertFalse(scheduler.greenlet.dead)
+        self.assertTrue(broken.closed)
+        self.assertGreaterEqual(len(ch.ws.sent), 3)
+
+        gevent.sleep(0.3)
+        self.assertTrue(ch.ws.closed)
+
+    def test_encode_once_per_key(self):
+        def f(job):
+            job.data["foo"] = {"n": 1}
+            time.sleep(0.3)
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "publisher"}, f)
+        time.sleep(0.05)
+
+        channels = [FakeChannel() for _ in range(20)]
+        for i, ch in enumerate(channels):
+            key = i % 2 and "foo" or None
+            sub = k3wsjobd.wsjobd.ProgressSubscription(job, ch, interval=10, key=key, max_rate=1000)
+            k3wsjobd.wsjobd.progress_scheduler.add(sub)
+
+        gevent.sleep(0.01)
+
+        with mock.patch("k3wsjobd.wsjobd.k3utfjson.dump", wraps=k3utfjson.dump) as dump:
+            job.progress_available.set()
+            gevent.sleep(0.01)
+
+        # one for the entire data and one for the key "foo"
+        self.assertEqual(2, dump.call_count)
+        for i, ch in enumerate(channels):
+            self.assertEqual(2, len(ch.ws.sent))
+            if i % 2:
+                self.assertEqual({"n": 1}, ch.ws.sent[-1])
+            else:
+                self.assertEqual({"n": 1}, ch.ws.sent[-1]["foo"])
+
+        for sub in list(job.subscriptions):
+            sub.close()
+        time.sleep(0.3)
+
+    def test_delta_frames(self):
+        def f(job):
+            job.data["n"] = 1
+            job.data["tmp"] = 1
+            time.sleep(0.1)
+            job.data["n"] = 2
+            del job.data["tmp"]
+            time.sleep(0.3)
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "delta", "big": [1] * 100}, f)
+        time.sleep(0.05)
+
+        ch = FakeChannel()
+        sub = k3wsjobd.wsjobd.ProgressSubscription(job, ch, interval=10, delta=True, max_rate=1000)
+        k3wsjobd.wsjobd.progress_scheduler.add(sub)
+        gevent.sleep(0.01)
+
+        epoch = job.publisher.deltas[None].epoch
+        self.assertEqual(
+            {"snapshot": {"ident": "delta", "big": [1] * 100, "n": 1, "tmp": 1}, "epoch": epoch, "version": 1},
+            ch.ws.sent[-1],
+        )
+
+        job.progress_available.set()
+        gevent.sleep(0.01)
+        self.assertEqual({"patch": {}, "epoch": epoch, "version": 1}, ch.ws.sent[-1])
+
+        time.sleep(0.1)
+        job.progress_available.set()
+        gevent.sleep(0.01)
+        self.assertEqual({"patch": {"n": 2, "tmp": None}, "epoch": epoch, "version": 2}, ch.ws.sent[-1])
+
+        sub.resync()
+        gevent.sleep(0.01)
+        self.assertEqual(
+            {"snapshot": {"ident": "delta", "big": [1] * 100, "n": 2}, "epoch": epoch, "version": 2}, ch.ws.sent[-1]
+        )
+
+        sub.close()
+
+        # a reconnecting client gets the changes since its version
+        ch = FakeChannel()
+        sub = k3wsjobd.wsjobd.ProgressSubscription(job, ch, interval=10, delta=True, since_epoch=epoch, since_version=1)
+        k3wsjobd.wsjobd.progress_scheduler.add(sub)
+        gevent.sleep(0.01)
+        self.assertEqual({"patch": {"n": 2, "tmp": None}, "epoch": epoch, "version": 2}, ch.ws.sent[-1])
+        sub.close()
+
+        # a version of another epoch, e.g., of the job before a restart, gets a snapshot
+        ch = FakeChannel()
+        sub = k3wsjobd.wsjobd.ProgressSubscription(
+            job, ch, interval=10, delta=True, since_epoch="other", since_version=1
+        )
+        k3wsjobd.wsjobd.progress_scheduler.add(sub)
+        gevent.sleep(0.01)
+        self.assertIn("snapshot", ch.ws.sent[-1])
+        sub.close()
+
+        time.sleep(0.3)
+
+    def test_delta_history(self):
+        delta = k3wsjobd.wsjobd.DeltaState()
+        for value in ({"a": 1}, {"a": 2}, {"a": 2, "b": 1}, [1], {"c": 1}, {"c": 2, "d": 1}):
+            delta.update(value)
+
+        self.assertEqual(6, delta.version)
+        self.assertEqual({}, delta.patch_since(6))
+        self.assertEqual({"c": 2, "d": 1}, delta.patch_since(5))
+        self.assertEqual({"c": 2, "d": 1}, delta.patch_since(4))
+        self.assertIsNone(delta.patch_since(7))
+
+        # a dict can not be composed into a merge-patch replacing another dict
+        self.assertIsNone(delta.patch_since(3))
+
+        delta = k3wsjobd.wsjobd.DeltaState()
+        for value in ({"a": 1, "b": 1}, {"a": 2, "b": 1}, {"a": 2}, {"a": 3}):
+            delta.update(value)
+        self.assertEqual({"a": 3, "b": None}, delta.patch_since(1))
+        self.assertEqual({"a": 3, "b": None}, delta.patch_since(0))
+
+        with mock.patch.object(k3wsjobd.wsjobd.DeltaState, "history_size", 2):
+            delta = k3wsjobd.wsjobd.DeltaState()
+            for i in range(5):
+                delta.update({"n": i})
+
+        # evicted
+        self.assertEqual({"n": 4}, delta.patch_since(3))
+        self.assertIsNone(delta.patch_since(2))
+
+    def test_codecs(self):
+        def f(job):
+            job.data["big"] = "x" * 2000
+            job.data["utf8"] = "\u00e9" * 600
+            time.sleep(0.2)
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "codec", "n": 1}, f)
+        time.sleep(0.05)
+
+        plain, packed, compressed, packed_big, utf8 = [FakeChannel(RawWebSocket()) for _ in range(5)]
+        packed.multiplex = True
+
+        subs = [
+            k3wsjobd.wsjobd.ProgressSubscription(job, plain, interval=10, key="n", codec="orjson"),
+            k3wsjobd.wsjobd.ProgressSubscription(job, packed, interval=10, key="n", codec="msgpack", compress=1000),
+            k3wsjobd.wsjobd.ProgressSubscription(job, compressed, interval=10, compress=1000),
+            k3wsjobd.wsjobd.ProgressSubscription(job, packed_big, interval=10, codec="msgpack", compress=1000),
+            k3wsjobd.wsjobd.ProgressSubscription(job, utf8, interval=10, key="utf8", compress=1000),
+        ]
+        for sub in subs:
+            k3wsjobd.wsjobd.progress_scheduler.add(sub)
+        gevent.sleep(0.01)
+
+        self.assertEqual(["1"], plain.ws.sent)
+        # small frames are not compressed
+        self.assertEqual([{"ident": "codec", "frame": 1}], [msgpack.unpackb(x) for x in packed.ws.sent])
+
+        frame = compressed.ws.sent[0]
+        self.assertIsInstance(frame, bytes)
+        self.assertEqual("x" * 2000, k3utfjson.load(zlib.decompress(frame))["big"])
+
+        # a compressed msgpack frame is marked, a plain one never starts with the marker
+        frame = packed_big.ws.sent[0]
+        self.assertEqual(b"\xc1", frame[:1])
+        self.assertEqual("x" * 2000, msgpack.unpackb(zlib.decompress(frame[1:]))["big"])
+        self.assertNotEqual(b"\xc1", packed.ws.sent[0][:1])
+
+        # 602 characters, but 1202 bytes
+        self.assertEqual('"' + "\u00e9" * 600 + '"', zlib.decompress(utf8.ws.sent[0]).decode("utf-8"))
+
+        time.sleep(0.3)
+        gevent.sleep(0.01)
+        self.assertEqual({"ident": "codec", "frame": {"status": "done"}}, msgpack.unpackb(packed.ws.sent[-1]))
+
+    def test_report_coalesced(self):
+        burst = {}
+
+        def f(job):
+            time.sleep(0.1)
+            # burst of updates
+            t0 = time.time()
+            for i in range(1000):
+                job.report(n=i)
+                time.sleep(0.0003)
+            burst["duration"] = time.time() - t0
+            time.sleep(0.1)
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "report"}, f)
+
+        ch = FakeChannel()
+        sub = k3wsjobd.wsjobd.ProgressSubscription(job, ch, interval=10, max_rate=20)
+        k3wsjobd.wsjobd.progress_scheduler.add(sub)
+        gevent.sleep(0.05)
+        self.assertEqual(1, len(ch.ws.sent))
+
+        # the first report is sent at once, not after interval
+        gevent.sleep(0.1)
+        self.assertGreaterEqual(len(ch.ws.sent), 2)
+        self.assertIn("n", ch.ws.sent[1])
+
+        while not job.ended.is_set():
+            gevent.sleep(0.05)
+        gevent.sleep(0.05)
+
+        # 20 frames per second during the burst, plus the first frames, the final frame and the terminal frame
+        self.assertLessEqual(len(ch.ws.sent), burst["duration"] * 20 + 6)
+        self.assertGreaterEqual(len(ch.ws.sent), burst["duration"] * 20 / 2)
+        self.assertEqual(999, ch.ws.sent[-2]["n"])
+        self.assertEqual({"status": "done"}, ch.ws.sent[-1])
+
+    def test_slow_client(self):
+        def f(job):
+            for i in range(10):
+                job.report(n=i)
+                time.sleep(0.05)
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "slow_client"}, f)
+
+        ch = FakeChannel()
+        stuck = FakeChannel(StuckWebSocket())
+
+        with mock.patch.object(k3wsjobd.wsjobd.ChannelOutbox, "deadline", 0.3):
+            for c in (ch, stuck):
+                sub = k3wsjobd.wsjobd.ProgressSubscription(job, c, interval=0.05, max_rate=1000)
+                c.subscriptions.append(sub)
+                k3wsjobd.wsjobd.progress_scheduler.add(sub)
+
+            gevent.sleep(0.2)
+
+            # only the latest progress is kept for the stuck client
+            self.assertEqual(1, len(stuck.outbox.frames))
+
+            gevent.sleep(0.2)
+            self.assertTrue(stuck.ws.closed)
+            self.assertEqual([], stuck.subscriptions)
+
+            while not job.ended.is_set():
+                gevent.sleep(0.05)
+            gevent.sleep(0.05)
+
+        # the other client is not affected
+        self.assertEqual(9, ch.ws.sent[-2]["n"])
+        self.assertEqual({"status": "done"}, ch.ws.sent[-1])
+        self.assertTrue(ch.ws.closed)
+
+
+class TestSystemLoadSampler(unittest.TestCase):
+    def test_get_without_blocking(self):
+        sampler = k3wsjobd.wsjobd.SystemLoadSampler(interval=0.1)
+        sampler.start()
+
+        t0 = time.time()
+        for _ in range(1000):
+            load = sampler.get()
+        self.assertLess(time.time() - t0, 0.1)
+
+        self.assertIn("mem_available", load)
+        self.assertIn("cpu_idle_percent", load)
+
+        # the snapshot is refreshed in background
+        first = sampler.snapshot
+        time.sleep(0.3)
+        self.assertIsNot(first, sampler.snapshot)
+
+
+class TestJobRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pkg = "registry_jobs_%d" % random.randint(10000, 99999)
+        os.mkdir(os.path.join(self.tmp, self.pkg))
+        with open(os.path.join(self.tmp, self.pkg, "__init__.py"), "w"):
+            pass
+        sys.path.insert(0, self.tmp)
+
+    def tearDown(self):
+        sys.path.remove(self.tmp)
+        shutil.rmtree(self.tmp)
+
+    def _write_job(self, name, rst, mtime):
+        path = os.path.join(self.tmp, self.pkg, name + ".py")
+        with open(path, "w") as f:
+            f.write("def run(job):\n    return %r\n" % rst)
+        os.utime(path, (mtime, mtime))
+
+    def test_cache_and_reload(self):
+        self._write_job("foo", "foo", 1000)
+
+        registry = k3wsjobd.wsjobd.JobRegistry(check_interval=0)
+        func = registry.get(self.pkg, "foo.run")
+        self.assertEqual("foo", func(None))
+        self.assertIs(func, registry.get(self.pkg, "foo.run"))
+
+        with mock.patch("importlib.import_module") as import_module:
+            registry.get(self.pkg, "foo.run")
+        self.assertEqual(0, import_module.call_count)
+
+        self._write_job("foo", "bar", 2000)
+        self.assertEqual("bar", registry.get(self.pkg, "foo.run")(None))
+
+        with self.assertRaises(k3wsjobd.LoadingError):
+            registry.get(self.pkg, "foo.inexistent")
+
+        with self.assertRaises(k3wsjobd.LoadingError):
+            registry.get(self.pkg, "inexistent.run")
+
+    def test_preload(self):
+        self._write_job("foo", "foo", 1000)
+        self._write_job("bar", "bar", 1000)
+
+        registry = k3wsjobd.wsjobd.JobRegistry()
+        registry.preload(self.pkg)
+
+        self.assertIn(self.pkg + ".foo", registry.modules)
+        self.assertIn(self.pkg + ".bar", registry.modules)
+
+
+class TestJobExecutor(unittest.TestCase):
+    def test_bounded_workers_and_queue(self):
+        executor = k3wsjobd.wsjobd.job_executor
+
+        def f(job):
+            time.sleep(0.2)
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+
+        with mock.patch.object(executor, "max_workers", 1), mock.patch.object(executor, "max_queue", 1):
+            a = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "a"}, f)
+            b = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "b"}, f)
+
+            with self.assertRaises(k3wsjobd.SystemOverloadError):
+                k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "c"}, f)
+            self.assertNotIn("c", Job.sessions)
+
+            self.assertIsNone(executor.position(a))
+            self.assertEqual(1, executor.position(b))
+
+            ch = FakeChannel()
+            k3wsjobd.wsjobd.progress_scheduler.add(k3wsjobd.wsjobd.ProgressSubscription(b, ch, interval=10))
+            gevent.sleep(0.05)
+            self.assertEqual({"status": "queued", "position": 1}, ch.ws.sent[-1])
+
+            # b is sent progress as soon as it starts
+            gevent.sleep(0.2)
+            self.assertEqual("running", b.status)
+            self.assertEqual("b", ch.ws.sent[-1]["ident"])
+            self.assertIs(a.thread, b.thread)
+
+            time.sleep(0.2)
+            self.assertEqual("done", b.status)
+            self.assertEqual(0, executor.running)
+
+        for sub in list(b.subscriptions):
+            sub.close()
+
+    def test_fair_queuing(self):
+        executor = k3wsjobd.wsjobd.job_executor
+        policy = k3wsjobd.wsjobd.admission_policy
+        ev = threading.Event()
+        order = []
+
+        def f(job):
+            ev.wait(1)
+            order.append(job.ident)
+
+        def submit(ident, tenant, **kwargs):
+            msg = dict(ident=ident, tenant=tenant, **kwargs)
+            return k3wsjobd.wsjobd.get_or_create_job("channel", msg, f)
+
+        with mock.patch.object(executor, "max_workers", 1), mock.patch.object(policy, "tenant_field", "tenant"):
+            jobs = [submit("blocker", "a")]
+            jobs += [submit("a%d" % i, "a") for i in range(4)]
+            jobs += [submit("b0", "b"), submit("b1", "b")]
+            jobs.append(submit("c0", "c", priority=4))
+
+            self.assertEqual(1, executor.position(jobs[-1]))
+            self.assertEqual(5, executor.position(jobs[-2]))
+            self.assertEqual(7, executor.position(jobs[4]))
+
+            # ranked once for all queued jobs
+            ranks = executor.ranks
+            self.assertEqual(list(range(1, 8)), sorted(executor.position(job) for job in jobs[1:]))
+            self.assertIs(ranks, executor.ranks)
+
+            ev.set()
+            for job in jobs:
+                self.assertTrue(job.ended.wait(2))
+
+        # "a" flooding jobs does not starve "b"
+        self.assertEqual(["blocker", "c0", "a0", "b0", "a1", "b1", "a2", "a3"], order)
+
+        stats = executor.wait_stats()
+        self.assertGreaterEqual(stats[4]["count"], 1)
+        self.assertGreater(stats[1]["max"], stats[4]["max"])
+
+    def test_invalid_tenant(self):
+        executor = k3wsjobd.wsjobd.job_executor
+        policy = k3wsjobd.wsjobd.admission_policy
+        app = object.__new__(k3wsjobd.JobdWebSocketApplication)
+        ev = threading.Event()
+
+        def f(job):
+            ev.wait(1)
+
+        with mock.patch.object(executor, "max_workers", 1), mock.patch.object(policy, "tenant_field", "tenant"):
+            self.assertRaises(
+                k3wsjobd.InvalidMessageError, app._check_msg, {"ident": "t0", "func": "a.f", "tenant": ["a"]}
+            )
+
+            blocker = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "blocker"}, f)
+
+            # a job failing to queue is not left in sessions, nor holds its admission slot
+            with self.assertRaises(TypeError):
+                k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "t1", "tenant": ["a"]}, f)
+            self.assertNotIn("t1", Job.sessions)
+            self.assertEqual(1, policy.jobs)
+
+            ev.set()
+            self.assertTrue(blocker.ended.wait(1))
+
+
+class TestCoroutineJob(unittest.TestCase):
+    def test_many_coroutine_jobs(self):
+        async def f(job):
+            await asyncio.sleep(0.2)
+            job.data["result"] = job.ident
+
+        n_threads = threading.active_count()
+
+        jobs = []
+        for i in range(1000):
+            jobs.append(k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "coroutine_%d" % i}, f))
+
+        # the loop thread
+        self.assertLessEqual(threading.active_count(), n_threads + 1)
+
+        for job in jobs:
+            self.assertTrue(job.ended.wait(2))
+            self.assertEqual(job.ident, job.data["result"])
+
+        self.assertEqual(0, len(Job.sessions))
+
+    def test_coroutine_job_exception(self):
+        async def f(job):
+            raise ValueError("foo")
+
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "coroutine_err"}, f)
+        self.assertTrue(job.ended.wait(1))
+        self.assertIsInstance(job.err, ValueError)
+
+
+class TestProcessJob(unittest.TestCase):
+    def test_flush_changing_data(self):
+        def f(job):
+            t0 = time.monotonic()
+            i = 0
+            while time.monotonic() - t0 < 0.3:
+                for _ in range(100):
+                    job.data["k%d" % i] = i
+                    i += 1
+                time.sleep(0.001)
+
+        q = queue.Queue()
+        with mock.patch.object(k3wsjobd.wsjobd, "_process_job_queue", q):
+            k3wsjobd.wsjobd._process_job_run("token", f, "flush", {}, 0.01, threading.Event())
+
+        # the flusher survives `job.data` changed while diffing it
+        self.assertGreater(q.qsize(), 10)
+
+    def test_job_api(self):
+        def f(job):
+            job.report(n=1)
+            job.update()
+            job.data["cancelled"] = job.cancelled.is_set()
+
+        cancelled = threading.Event()
+        cancelled.set()
+        with mock.patch.object(k3wsjobd.wsjobd, "_process_job_queue", queue.Queue()):
+            data = k3wsjobd.wsjobd._process_job_run("token", f, "api", {}, 0.01, cancelled)
+
+        self.assertEqual({"n": 1, "cancelled": True}, data)
+
+
+class TestJobCancel(unittest.TestCase):
+    def test_cancel_coroutine_job(self):
+        async def f(job):
+            await asyncio.sleep(10)
+
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "coroutine_cancel"}, f)
+        time.sleep(0.1)
+
+        job.cancel()
+        self.assertTrue(job.ended.wait(1))
+        self.assertIsNone(job.err)
+        self.assertEqual('{"status": "cancelled"}', job.publisher.terminal_frame(k3wsjobd.wsjobd.CODECS["json"]))
+
+    def test_cancel_queued_job(self):
+        executor = k3wsjobd.wsjobd.job_executor
+        runs = []
+
+        def f(job):
+            runs.append(job.ident)
+            time.sleep(0.2)
+
+        with mock.patch.object(executor, "max_workers", 1):
+            a = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "a"}, f)
+            b = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "b"}, f)
+            b.cancel()
+
+            self.assertTrue(b.ended.wait(1))
+            self.assertTrue(a.ended.is_set())
+
+        self.assertEqual(["a"], runs)
+
+    def test_orphan_relay(self):
+        cluster = k3wsjobd.wsjobd.WorkerCluster()
+        cluster.relay_interval = 0.01
+
+        def f(job):
+            job.cancelled.wait(1)
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "orphan_relay"}, f)
+
+        sub = k3wsjobd.wsjobd.ProgressSubscription(job, FakeChannel())
+        k3wsjobd.wsjobd.progress_scheduler.add(sub)
+
+        owner, reader = gevent.socket.socketpair()
+        reader.sendall(b'{"ident": "orphan_relay"}\n')
+        handler = gevent.spawn(cluster._handle, owner, None)
+        reader.recv(1024)
+
+        # watched by a relay job of another worker
+        sub.close()
+        self.assertEqual(1, job.subscribers())
+        self.assertIsNone(job.orphaned_at)
+
+        reader.close()
+        handler.join(1)
+        self.assertEqual(0, job.subscribers())
+        self.assertIsNotNone(job.orphaned_at)
+
+        job.cancel()
+        self.assertTrue(job.ended.wait(1))
+
+    def test_rejected_batch(self):
+        app = object.__new__(k3wsjobd.JobdWebSocketApplication)
+        app.multiplex = False
+        app.subscriptions = []
+        app.proxies = []
+
+        existing = k3wsjobd.wsjobd.get_or_create_job(
+            "channel", {"ident": "batch_0"}, lambda job: job.cancelled.wait(0.5)
+        )
+
+        descs = [{"ident": "batch_%d" % i, "func": "test_job_cancel.run"} for i in range(4)]
+        msg = {"batch": descs, "jobs_dir": "k3wsjobd/test/test_jobs"}
+
+        executor = k3wsjobd.wsjobd.job_executor
+        policy = k3wsjobd.wsjobd.admission_policy
+
+        with mock.patch.object(k3wsjobd.wsjobd, "get_or_create_job") as create:
+            # 3 new jobs, the existing one is not counted
+            with mock.patch.object(policy, "max_jobs", 3):
+                self.assertRaises(k3wsjobd.SystemOverloadError, app._submit_batch, msg)
+
+            with mock.patch.multiple(executor, max_workers=1, max_queue=2):
+                self.assertRaises(k3wsjobd.SystemOverloadError, app._submit_batch, msg)
+
+            # no job is created to roll back
+            create.assert_not_called()
+
+        self.assertEqual(["batch_0"], [ident for ident in Job.sessions if ident.startswith("batch_")])
+        self.assertFalse(existing.cancelled.is_set())
+        self.assertTrue(existing.ended.wait(1))
+
+        # retried when there is room
+        with mock.patch.object(policy, "max_jobs", 4):
+            app._submit_batch(msg)
+
+        jobs = [Job.sessions["batch_%d" % i] for i in range(4)]
+        self.assertFalse(any(job.cancelled.is_set() for job in jobs))
+        for job in jobs:
+            job.cancel()
+            self.assertTrue(job.ended.wait(1))
+
+    def test_orphan(self):
+        reaper = k3wsjobd.wsjobd.OrphanReaper(grace=0.1)
+
+        def f(job):
+            while not job.cancelled.wait(0.01):
+                pass
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+        job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "orphan"}, f)
+
+        # never subscribed
+        reaper.reap()
+        self.assertIsNone(job.orphaned_at)
+
+        subs = [k3wsjobd.wsjobd.ProgressSubscription(job, FakeChannel()) for _ in range(2)]
+        for sub in subs:
+            k3wsjobd.wsjobd.progress_scheduler.add(sub)
+        self.assertEqual(2, len(job.subscriptions))
+
+        subs[0].close()
+        self.assertIsNone(job.orphaned_at)
+        subs[1].close()
+        self.assertIsNotNone(job.orphaned_at)
+
+        reaper.reap()
+        self.assertFalse(job.cancelled.is_set())
+
+        # subscribed again in grace period
+        sub = k3wsjobd.wsjobd.ProgressSubscription(job, FakeChannel())
+        k3wsjobd.wsjobd.progress_scheduler.add(sub)
+        time.sleep(0.15)
+        reaper.reap()
+        self.assertFalse(job.cancelled.is_set())
+
+        sub.close()
+        time.sleep(0.15)
+        reaper.reap()
+        self.assertTrue(job.ended.wait(1))
+        self.assertTrue(job.cancelled.is_set())
+
+
+class TestJobResultCache(unittest.TestCase):
+    def test_cached_result(self):
+        cache = k3wsjobd.wsjobd.job_result_cache
+        runs = []
+
+        def f(job):
+            runs.append(job.ident)
+            job.data["result"] = len(runs)
+
+        k3wsjobd.wsjobd.progress_scheduler.start()
+
+        with mock.patch.object(cache, "size", 2), mock.patch.object(cache, "ttl", 0.3):
+            job = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "cached"}, f)
+            self.assertTrue(job.ended.wait(1))
+
+            # got at once without running again
+            cached = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "cached"}, f)
+            self.assertIs(job, cached)
+            self.assertEqual(["cached"], runs)
+
+            ch = FakeChannel()
+            k3wsjobd.wsjobd.progress_scheduler.add(k3wsjobd.wsjobd.ProgressSubscription(cached, ch, interval=10))
+            gevent.sleep(0.01)
+            self.assertEqual([{"ident": "cached", "result": 1}, {"status": "done"}], ch.ws.sent)
+
+            # lru
+            for ident in ("a", "b"):
+                k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": ident}, f).ended.wait(1)
+            self.assertIsNone(cache.get("cached"))
+            self.assertIsNotNone(cache.get("a"))
+
+            # ttl
+            time.sleep(0.3)
+            self.assertIsNone(cache.get("a"))
+
+        cache.jobs.clear()
+
+
+class TestAdmissionPolicy(unittest.TestCase):
+    def test_limits(self):
+        policy = k3wsjobd.wsjobd.admission_policy
+        ev = threading.Event()
+
+        def f(job):
+            ev.wait(1)
+
+        def submit(ident, func="a.f", tenant="t1"):
+            return k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": ident, "func": func, "tenant": tenant}, f)
+
+        limits = dict(max_jobs=3, max_jobs_per_func={"a.f": 2}, rate=1, burst=2, tenant_field="tenant")
+        with mock.patch.multiple(policy, **limits):
+            jobs = [submit("adm_1"), submit("adm_2", func="b.f")]
+
+            # rate limited per tenant
+            with self.assertRaises(k3wsjobd.SystemOverloadError):
+                submit("adm_3", func="b.f")
+
+            # per func
+            jobs.append(submit("adm_4", tenant="t2"))
+            with self.assertRaises(k3wsjobd.SystemOverloadError):
+                submit("adm_5", tenant="t3")
+
+            # in total
+            with self.assertRaises(k3wsjobd.SystemOverloadError):
+                submit("adm_6", func="c.f", tenant="t3")
+            self.assertEqual(["adm_1", "adm_2", "adm_4"], sorted(Job.sessions))
+
+            # attaching to a running job is not a new job
+            self.assertIs(jobs[0], submit("adm_1", tenant="t2"))
+
+            ev.set()
+            for job in jobs:
+                self.assertTrue(job.ended.wait(1))
+
+            self.assertEqual(0, policy.jobs)
+            self.assertEqual({}, policy.jobs_per_func)
+            submit("adm_7", tenant="t3").ended.wait(1)
+
+        policy.buckets.clear()
+
+    def test_rate_below_one(self):
+        policy = k3wsjobd.wsjobd.AdmissionPolicy(rate=0.5)
+        now = time.monotonic()
+
+        with mock.patch("k3wsjobd.wsjobd.time.monotonic", return_value=now):
+            policy.admit("channel", {"func": "a.f"})
+            self.assertRaises(k3wsjobd.SystemOverloadError, policy.admit, "channel", {"func": "a.f"})
+
+        # a token every 2 seconds
+        with mock.patch("k3wsjobd.wsjobd.time.monotonic", return_value=now + 2):
+            policy.admit("channel", {"func": "a.f"})
+
+        self.assertEqual(2, policy.jobs)
+
+    def test_check(self):
+        policy = k3wsjobd.wsjobd.AdmissionPolicy(max_jobs_per_func={"a.f": 2}, rate=1, burst=3, tenant_field="tenant")
+        msgs = [{"func": "a.f", "tenant": "t1"}, {"func": "b.f", "tenant": "t1"}, {"func": "b.f", "tenant": "t2"}]
+
+        policy.check("channel", msgs)
+        self.assertRaises(k3wsjobd.SystemOverloadError, policy.check, "channel", msgs + [{"func": "a.f"}] * 2)
+        self.assertRaises(
+            k3wsjobd.SystemOverloadError, policy.check, "channel", msgs + [{"func": "b.f", "tenant": "t1"}] * 2
+        )
+
+        # nothing is counted
+        self.assertEqual(0, policy.jobs)
+        self.assertEqual({}, policy.buckets)
+
+    def test_invalid_limits(self):
+        for limits in ({"rate": 0}, {"rate": "1"}, {"burst": 0.5}, {"max_jobs": -1}, {"max_jobs": True}):
+            self.assertRaises(ValueError, k3wsjobd.run, admission=limits)
+
+    def test_tenant(self):
+        policy = k3wsjobd.wsjobd.AdmissionPolicy(tenant_field="tenant")
+        ws = FakeWebSocket()
+        ws.environ = {"REMOTE_ADDR": "10.0.0.1"}
+
+        self.assertEqual("10.0.0.1", policy.tenant(FakeChannel(ws), {}))
+        self.assertEqual("foo", policy.tenant(FakeChannel(ws), {"tenant": "foo"}))
+        self.assertIsNone(policy.tenant("channel", {}))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        m = k3wsjobd.wsjobd.Metrics()
+        m.gauge("g", "a gauge.", lambda: 3)
+        m.counter("c", "a counter.")
+        m.histogram("h", "a histogram.", (1, 2))
+
+        m.inc("c", (("err", 'a"b'),))
+        m.inc("c", (("err", 'a"b'),), 2)
+        for v in (0.5, 1.5, 1.5, 5):
+            m.observe("h", v, (("func", "f"),))
+
+        self.assertEqual(
+            [
+                "# HELP g a gauge.",
+                "# TYPE g gauge",
+                "g 3",
+                "# HELP c a counter.",
+                "# TYPE c counter",
+                'c{err="a\\"b"} 3',
+                "# HELP h a histogram.",
+                "# TYPE h histogram",
+                'h_bucket{func="f",le="1"} 1',
+                'h_bucket{func="f",le="2"} 3',
+                'h_bucket{func="f",le="+Inf"} 4',
+                'h_sum{func="f"} 8.5',
+                'h_count{func="f"} 4',
+                "",
+            ],
+            m.render().split("\n"),
+        )
+
+
+class TestRequestTracer(unittest.TestCase):
+    def test_chrome_format(self):
+        path = os.path.join(tempfile.mkdtemp(), "trace.json")
+        tracer = k3wsjobd.wsjobd.RequestTracer()
+
+        self.assertIsNone(tracer.begin({"ident": "a", "trace": True}, 1))
+
+        tracer.open(path, "chrome")
+        self.assertIsNone(tracer.begin({"ident": "a"}, 1))
+
+        trace = tracer.begin({"ident": "a", "trace": True}, 1)
+        trace.add("jobq", 1, 2)
+        trace.wait("first_send")
+        trace.close()
+
+        # not written until all spans end
+        with open(path) as f:
+            self.assertEqual("[\n", f.read())
+
+        trace.end("first_send")
+        with open(path) as f:
+            events = k3utfjson.load(f.read().rstrip(",\n") + "]")
+
+        self.assertEqual(["jobq", "first_send"], [e["name"] for e in events])
+        self.assertEqual(("X", 1000000, 1000000), (events[0]["ph"], events[0]["ts"], events[0]["dur"]))
+        self.assertEqual("a", events[1]["args"]["request"])
+
+        shutil.rmtree(os.path.dirname(path))
+
+
+class TestWorkerCluster(unittest.TestCase):
+    port = 33447
+
+    @classmethod
+    def setUpClass(cls):
+        script = "import k3wsjobd; k3wsjobd.run(port=%d, workers=2, preload_jobs_dirs=['k3wsjobd/test/test_jobs'])"
+        cls.server = subprocess.Popen(
+            [sys.executable, "-c", script % cls.port],
+            env=dict(os.environ, PYTHONPATH=this_base + "/../.."),
+        )
+        time.sleep(1.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.send_signal(signal.SIGTERM)
+        cls.server.wait()
+
+    def test_restart_backoff(self):
+        script = "\n".join(
+            [
+                "import k3wsjobd",
+                "cluster = k3wsjobd.wsjobd.worker_cluster",
+                "cluster.restart_delay, cluster.max_quick_deaths = 0.1, 3",
+                "def serve():",
+                "    raise Exception('broken')",
+                "k3wsjobd.wsjobd._run_workers(2, serve)",
+            ]
+        )
+        tmp = tempfile.mkdtemp()
+        t0 = time.time()
+        proc = subprocess.run(
+            [sys.executable, "-c", script],
+            env=dict(os.environ, PYTHONPATH=this_base + "/../..", TMPDIR=tmp),
+            stderr=subprocess.DEVNULL,
+            timeout=10,
+        )
+
+        # it gives up after restarting in 0.2 and 0.4 seconds
+        self.assertEqual(1, proc.returncode)
+        self.assertGreaterEqual(time.time() - t0, 0.6)
+        self.assertEqual([], os.listdir(tmp))
+        os.rmdir(tmp)
+
+    def test_same_ident_across_workers(self):
+        job_desc = {
+            "func": "test_job_pid.run",
+            "ident": "cluster_%d" % random.randint(10000, 99999),
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+            "progress": {"interval": 0.1},
+        }
+
+        clients = []
+        for _ in range(8):
+            ws = websocket.WebSocket()
+            ws.connect("ws://127.0.0.1:%d" % self.port)
+            ws.timeout = 6
+            ws.send(k3utfjson.dump(job_desc))
+            clients.append(ws)
+
+        results = []
+        for ws in clients:
+            frames = []
+            while True:
+                frames.append(k3utfjson.load(ws.recv()))
+                if frames[-1] == {"status": "done"}:
+                    break
+            results.append(frames[-2])
+            ws.close()
+
+        # the job runs once in one of the workers
+        self.assertEqual(1, len(set(r["pid"] for r in results)))
+        self.assertEqual(["foo"] * 8, [r["result"] for r in results])
+
+    def test_release_claim_on_rejection(self):
+        cluster = k3wsjobd.wsjobd.worker_cluster
+        policy = k3wsjobd.wsjobd.admission_policy
+        executor = k3wsjobd.wsjobd.job_executor
+
+        def f(job):
+            time.sleep(0.2)
+
+        with mock.patch.object(cluster, "index", 0), mock.patch.object(cluster, "dir", tempfile.mkdtemp()):
+            cluster.init(cluster.dir)
+
+            with mock.patch.object(policy, "max_jobs", 0):
+                self.assertRaises(
+                    k3wsjobd.SystemOverloadError, k3wsjobd.wsjobd.get_or_create_job, "channel", {"ident": "x"}, f
+                )
+            self.assertIsNone(cluster.owner("x"))
+
+            limits = {"max_workers": 1, "max_queue": 0}
+            with mock.patch.multiple(executor, **limits):
+                a = k3wsjobd.wsjobd.get_or_create_job("channel", {"ident": "a"}, f)
+                self.assertRaises(
+                    k3wsjobd.SystemOverloadError, k3wsjobd.wsjobd.get_or_create_job, "channel", {"ident": "y"}, f
+                )
+                self.assertIsNone(cluster.owner("y"))
+                self.assertTrue(a.ended.wait(1))
+
+            shutil.rmtree(cluster.dir)
+
+    def test_claim(self):
+        cluster = k3wsjobd.wsjobd.WorkerCluster()
+        cluster.index = 0
+        cluster.init(tempfile.mkdtemp())
+
+        other = k3wsjobd.wsjobd.WorkerCluster()
+        other.index = 1
+        other.dir = cluster.dir
+
+        self.assertIsNone(cluster.claim("a"))
+
+        with mock.patch("os.getpid", return_value=os.getpid() + 1):
+            self.assertEqual(0, other.claim("a"))
+
+            # the owner has gone
+            with mock.patch.object(k3wsjobd.wsjobd.psutil, "pid_exists", return_value=False):
+                self.assertIsNone(other.claim("a"))
+
+            self.assertEqual(1, cluster.owner("a"))
+
+            other.release("a")
+            self.assertIsNone(cluster.owner("a"))
+
+        shutil.rmtree(cluster.dir)
+
+
+class TestCluster(unittest.TestCase):
+    ports = (33448, 33449)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nodes = ["127.0.0.1:%d" % p for p in cls.ports]
+        script = (
+            "import k3wsjobd; k3wsjobd.run(port=%d, preload_jobs_dirs=['k3wsjobd/test/test_jobs'],"
+            " cluster_nodes=%r, cluster_redirect=%r)"
+        )
+        cls.servers = [
+            subprocess.Popen(
+                [sys.executable, "-c", script % (port, cls.nodes, redirect)],
+                env=dict(os.environ, PYTHONPATH=this_base + "/../.."),
+            )
+            for port, redirect in zip(cls.ports, (False, True))
+        ]
+        time.sleep(1.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+    def _ident_of(self, ring, node):
+        while True:
+            ident = "cluster_%d" % random.randint(10000, 99999)
+            if ring.owner(ident) == node:
+                return ident
+
+    def _job_desc(self, ident):
+        return {
+            "func": "test_job_echo.run",
+            "ident": ident,
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+            "echo": "hello",
+        }
+
+    def test_proxy(self):
+        ident = self._ident_of(k3wsjobd.wsjobd.HashRing(self.nodes), self.nodes[1])
+
+        ws = websocket.WebSocket()
+        ws.connect("ws://%s" % self.nodes[0])
+        ws.timeout = 6
+        ws.send(k3utfjson.dump(self._job_desc(ident)))
+
+        frames = []
+        while True:
+            frame = ws.recv()
+            if not frame:
+                break
+            frames.append(k3utfjson.load(frame))
+
+        ws.close()
+        self.assertEqual("hello", frames[0]["result"])
+
+    def test_redirect(self):
+        ident = self._ident_of(k3wsjobd.wsjobd.HashRing(self.nodes), self.nodes[0])
+
+        ws = websocket.WebSocket()
+        ws.connect("ws://%s" % self.nodes[1])
+        ws.timeout = 6
+        ws.send(k3utfjson.dump(self._job_desc(ident)))
+
+        self.assertEqual({"redirect": self.nodes[0]}, k3utfjson.load(ws.recv()))
+        ws.close()
+
+    def test_batch(self):
+        ring = k3wsjobd.wsjobd.HashRing(self.nodes)
+        own = self._ident_of(ring, self.nodes[0])
+        other = self._ident_of(ring, self.nodes[1])
+
+        ws = websocket.WebSocket()
+        ws.connect("ws://%s" % self.nodes[0])
+        ws.timeout = 6
+        ws.send(k3utfjson.dump({"batch": [self._job_desc(own), self._job_desc(other)]}))
+
+        resp = k3utfjson.load(ws.recv())
+        ws.close()
+
+        self.assertEqual("RoutingError", resp["err"])
+        self.assertEqual([[other, self.nodes[1]]], resp["val"][1])
+
+    def test_hash_ring(self):
+        ring = k3wsjobd.wsjobd.HashRing(["a", "b", "c"])
+        idents = ["ident_%d" % i for i in range(1000)]
+        owners = [ring.owner(i) for i in idents]
+
+        self.assertEqual(set(["a", "b", "c"]), set(owners))
+        for node in "abc":
+            self.assertGreater(owners.count(node), 200)
+
+        # removing a node moves only the idents it owns
+        ring2 = k3wsjobd.wsjobd.HashRing(["a", "b"])
+        for ident, owner in zip(idents, owners):
+            if owner != "c":
+                self.assertEqual(owner, ring2.owner(ident))
+
+        self.assertIsNone(k3wsjobd.wsjobd.HashRing().owner("x"))
+
+    def test_route(self):
+        router = k3wsjobd.wsjobd.ClusterRouter()
+        self.assertIsNone(router.route({"ident": "x"}))
+
+        router.configure("a", ["a", "b"], redirect=True)
+        ident = self._ident_of(router.ring, "b")
+        self.assertEqual("b", router.route({"ident": ident}))
+        self.assertIsNone(router.route({"ident": ident, "routed_by": "b"}))
+
+        ident = self._ident_of(router.ring, "a")
+        self.assertIsNone(router.route({"ident": ident}))
+
+        self.assertRaises(ValueError, router.configure, "c", ["a", "b"])
+
+
+class TestJobJournal(unittest.TestCase):
+    port = 33450
+
+    def _start_server(self, journal_dir):
+        script = "import k3wsjobd; k3wsjobd.run(port=%d, preload_jobs_dirs=['k3wsjobd/test/test_jobs'], journal_dir=%r)"
+        server = subprocess.Popen(
+            [sys.executable, "-c", script % (self.port, journal_dir)],
+            env=dict(os.environ, PYTHONPATH=this_base + "/../.."),
+        )
+        time.sleep(1.5)
+        return server
+
+    def _connect(self, job_desc):
+        ws = websocket.WebSocket()
+        ws.connect("ws://127.0.0.1:%d" % self.port)
+        ws.timeout = 10
+        ws.send(k3utfjson.dump(job_desc))
+        return ws
+
+    def test_resume(self):
+        journal_dir = tempfile.mkdtemp()
+        job_desc = {
+            "func": "test_job_checkpoint.run",
+            "ident": "journal_%d" % random.randint(10000, 99999),
+            "jobs_dir": "k3wsjobd/test/test_jobs",
+            "progress": {"interval": 0.1},
+        }
+
+        server = self._start_server(journal_dir)
+        try:
+            ws = self._connect(job_desc)
+            while k3utfjson.load(ws.recv()).get("n", 0) < 3:
+                pass
+        finally:
+            server.kill()
+            server.wait()
+
+        self.assertEqual(1, len(os.listdir(journal_dir)))
+
+        server = self._start_server(journal_dir)
+        try:
+            ws = self._connect(job_desc)
+
+            frames = []
+            while True:
+                frame = ws.recv()
+                if not frame:
+                    break
+                frames.append(k3utfjson.load(frame))
+            ws.close()
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+        # the job is resumed from its last checkpoint
+        self.assertEqual({"status": "done"}, frames[-1])
+        self.assertGreaterEqual(frames[-2]["restored"], 3)
+        self.assertEqual("foo", frames[-2]["result"])
+        self.assertEqual([], os.listdir(journal_dir))
+
+        shutil.rmtree(journal_dir)
+
+    def test_resume_over_limits(self):
+        journal = k3wsjobd.wsjobd.job_journal
+        executor = k3wsjobd.wsjobd.job_executor
+        policy = k3wsjobd.wsjobd.admission_policy
+        journal_dir = tempfile.mkdtemp()
+
+        with mock.patch.object(journal, "dir", journal_dir):
+            for i in range(3):
+                ident = "resume_%d" % i
+                data = {"ident": ident, "func": "test_job_normal.run"}
+                job = mock.Mock(ident=ident, data=data, owner=None, jobs_dir="k3wsjobd/test/test_jobs")
+                journal.open(job)
+                journal.sync(job)
+                # left by a crash
+                journal.journals.pop(ident)[0].close()
+
+            limits = {"max_workers": 1, "max_queue": 0}
+            with mock.patch.multiple(executor, **limits), mock.patch.object(policy, "max_jobs", 1):
+                journal.resume()
+
+                for _ in range(100):
+                    if len(os.listdir(journal_dir)) == 0:
+                        break
+                    time.sleep(0.05)
+
+        # all of them are run, none is dropped
+        self.assertEqual([], os.listdir(journal_dir))
+        self.assertEqual(0, policy.jobs)
+        shutil.rmtree(journal_dir)
+
+    def test_resume_broken(self):
+        journal = k3wsjobd.wsjobd.job_journal
+        registry = k3wsjobd.wsjobd.job_registry
+        journal_dir = tempfile.mkdtemp()
+        resumed = []
+
+        def f(job):
+            resumed.append((dict(job.data), job.restored))
+
+        start = {"op": "start", "msg": {"ident": "broken_0", "func": "a.run", "x": 1}, "jobs_dir": "jobs"}
+        journals = {
+            "broken_0": [
+                start,
+                {"op": "checkpoint", "data": {"ident": "broken_0", "n": 2}, "state": 2},
+                {"op": "snapshot", "data": [1]},
+            ],
+            "no_ident": [{"op": "start", "msg": {"func": "a.run"}, "jobs_dir": "jobs"}],
+            "not_dict": [5],
+        }
+
+        with mock.patch.object(journal, "dir", journal_dir), mock.patch.object(registry, "get", return_value=f):
+            for ident, records in journals.items():
+                with open(journal._path(ident), "w") as f_:
+                    f_.write("".join(k3utfjson.dump(r) + "\n" for r in records))
+
+            journal.resume()
+            failed = sorted(journal._path(ident) + ".failed" for ident in ("no_ident", "not_dict"))
+
+            for _ in range(20):
+                if len(os.listdir(journal_dir)) == 2:
+                    break
+                time.sleep(0.05)
+
+        # data of the last checkpoint, not of the last line
+        self.assertEqual([({"ident": "broken_0", "func": "a.run", "n": 2}, 2)], resumed)
+        self.assertEqual(failed, sorted(os.path.join(journal_dir, x) for x in os.listdir(journal_dir)))
+        shutil.rmtree(journal_dir)
+
+    def test_sync(self):
+        journal = k3wsjobd.wsjobd.JobJournal()
+        journal.dir = tempfile.mkdtemp()
+
+        # opened with Job.lock held, it does not touch the disk
+        a = mock.Mock(ident="a", data={"ident": "a", "func": "f.run"}, owner=None, jobs_dir="jobs")
+        journal.open(a)
+        self.assertEqual([], os.listdir(journal.dir))
+
+        journal.sync(a)
+        self.assertEqual(["start"], [r["op"] for r in journal._read(journal._path("a"))])
+
+        # a checkpoint before sync writes the start line first
+        b = mock.Mock(ident="b", data={"ident": "b", "func": "f.run"}, owner=None, jobs_dir="jobs")
+        journal.open(b)
+        journal.write(b, "checkpoint", 1)
+        self.assertEqual(["start", "checkpoint"], [r["op"] for r in journal._read(journal._path("b"))])
+
+        # ended before sync
+        c = mock.Mock(ident="c", data={"ident": "c", "func": "f.run"}, owner=None, jobs_dir="jobs")
+        journal.open(c)
+        journal.close(c)
+        journal.sync(c)
+
+        journal.close(a)
+        journal.close(b)
+        self.assertEqual([], os.listdir(journal.dir))
+        shutil.rmtree(journal.dir)
+
+    def test_compact(self):
+        journal = k3wsjobd.wsjobd.JobJournal(max_size=300)
+        journal.dir = tempfile.mkdtemp()
+
+        job = mock.Mock(ident="a", data={"ident": "a", "func": "f.run"}, owner=None, jobs_dir="jobs", restored=None)
+        journal.open(job)
+
+        journal.write(job, "checkpoint", 1)
+        for i in range(10):
+            job.data["n"] = i
+            journal.write(job)
+
+        path = journal._path("a")
+        records = journal._read(path)
+        # compacted
+        self.assertLess(len(records), 12)
+        self.assertEqual(["start", "checkpoint"], [r["op"] for r in records[:2]])
+        self.assertEqual({"ident": "a", "func": "f.run"}, records[0]["msg"])
+        self.assertEqual(1, records[1]["state"])
+        self.assertEqual(9, records[-1]["data"]["n"])
+
+        # a torn line is ignored
+        with open(path, "ab") as f:
+            f.write(b'{"op": "snap')
+        self.assertEqual(records, journal._read(path))
+
+        job2 = mock.Mock(ident="a", data=records[-1]["data"], owner=None, restored=None)
+        journal.journals.clear()
+        journal.open(job2, records)
+        self.assertEqual(1, job2.restored)
+
+        journal.close(job2)
+        self.assertEqual([], os.listdir(journal.dir))
+        shutil.rmtree(journal.dir)
@@ -4,10 +4,19 @@ import logging
 import k3wsjobd
 
 PORT = 33445
+METRICS_PORT = 33446
+TRACE_FILE = "/tmp/wsjobd_trace.jsonl"
 
 
 def run():
-    k3wsjobd.run(ip="127.0.0.1", port=PORT, jobq_thread_count=20)
+    k3wsjobd.run(
+        ip="127.0.0.1",
+        port=PORT,
+        jobq_thread_count=20,
+        preload_jobs_dirs=["k3wsjobd/test/test_jobs"],
+        metrics_port=METRICS_PORT,
+        trace_file=TRACE_FILE,
+    )
 
 
 if __name__ == "__main__":
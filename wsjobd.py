@@ -1,10 +1,40 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import asyncio
+import bisect
+import contextlib
+import functools
+import hashlib
+import heapq
+import importlib
+import inspect
+import itertools
+import json
 import logging
+import multiprocessing
+import os
+import pkgutil
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import tempfile
 import threading
+import time
+import zlib
 from collections import OrderedDict
-
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import gevent
+import gevent.event
+import gevent.pywsgi
+import gevent.select
+import gevent.server
+import gevent.socket
 import psutil
 from geventwebsocket import Resource
 from geventwebsocket import WebSocketApplication
@@ -15,12 +45,36 @@ import k3thread
 import k3utfjson
 import k3jobq
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
 logger = logging.getLogger(__name__)
 
 MEM_AVAILABLE = "mem_available"
 CPU_IDLE_PERCENT = "cpu_idle_percent"
 CLIENT_NUMBER = "client_number"
 JOBS_DIR = "jobs"
+COMPRESS_THRESHOLD = 1024
+# prefixed to a compressed binary frame, a MessagePack value never starts with it
+COMPRESSED_MARKER = b"\xc1"
+MAX_PRIORITY = 10
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
 
 # - `mem_low_threshold`
 # set the min size of available memory the system should have, if not satified, return error. the default is 500M
@@ -51,172 +105,2794 @@ CHECK_LOAD_PARAMS = {
 }
 
 
-class SystemOverloadError(Exception):
-    pass
+class SystemOverloadError(Exception):
+    pass
+
+
+class JobError(Exception):
+    pass
+
+
+class InvalidMessageError(JobError):
+    pass
+
+
+class InvalidProgressError(InvalidMessageError):
+    pass
+
+
+class LoadingError(JobError):
+    pass
+
+
+class JobNotInSessionError(JobError):
+    pass
+
+
+class RoutingError(JobError):
+    pass
+
+
+class RemoteJobError(Exception):
+    """
+    The exception of a job run by another worker, see `WorkerCluster`. `name` is the class name of the original
+    exception.
+    """
+
+    def __init__(self, name, *args):
+        super(RemoteJobError, self).__init__(*args)
+        self.name = name
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms of wsjobd, rendered in the Prometheus text format by `render`, and served by
+    `run(metrics_port)` at `/metrics`.
+
+    A gauge is a function called when rendering. Labels of a counter or a histogram are a tuple of `(name, value)`.
+    """
+
+    latency_buckets = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+    duration_buckets = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800, 3600)
+    size_buckets = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (help, function)
+        self.gauges = OrderedDict()
+        # name -> (help, {labels: value})
+        self.counters = OrderedDict()
+        # name -> (help, buckets, {labels: [count of every bucket, ..., sum, count]})
+        self.histograms = OrderedDict()
+
+    def gauge(self, name, help_, func):
+        self.gauges[name] = (help_, func)
+
+    def counter(self, name, help_):
+        self.counters[name] = (help_, {})
+
+    def histogram(self, name, help_, buckets):
+        self.histograms[name] = (help_, buckets, {})
+
+    def inc(self, name, labels=(), n=1):
+        values = self.counters[name][1]
+        with self.lock:
+            values[labels] = values.get(labels, 0) + n
+
+    def observe(self, name, value, labels=()):
+        _, buckets, values = self.histograms[name]
+
+        with self.lock:
+            counts = values.get(labels)
+            if counts is None:
+                # every bucket, +Inf, sum and count
+                counts = values[labels] = [0] * (len(buckets) + 3)
+
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(buckets)] += 1
+
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = []
+
+        for name, (help_, func) in self.gauges.items():
+            lines += ["# HELP %s %s" % (name, help_), "# TYPE %s gauge" % name]
+            lines.append("%s %s" % (name, func()))
+
+        with self.lock:
+            for name, (help_, values) in self.counters.items():
+                lines += ["# HELP %s %s" % (name, help_), "# TYPE %s counter" % name]
+                for labels, v in values.items():
+                    lines.append("%s%s %s" % (name, _labels_str(labels), v))
+
+            for name, (help_, buckets, values) in self.histograms.items():
+                lines += ["# HELP %s %s" % (name, help_), "# TYPE %s histogram" % name]
+                for labels, counts in values.items():
+                    n = 0
+                    for le, c in zip(buckets + ("+Inf",), counts):
+                        n += c
+                        lines.append("%s_bucket%s %d" % (name, _labels_str(labels + (("le", le),)), n))
+                    lines.append("%s_sum%s %s" % (name, _labels_str(labels), counts[-2]))
+                    lines.append("%s_count%s %d" % (name, _labels_str(labels), counts[-1]))
+
+        return "\n".join(lines) + "\n"
+
+    def wsgi_app(self, environ, start_response):
+        if environ.get("PATH_INFO") != "/metrics":
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"not found\n"]
+
+        body = self.render().encode("utf-8")
+        start_response(
+            "200 OK",
+            [("Content-Type", "text/plain; version=0.0.4; charset=utf-8"), ("Content-Length", str(len(body)))],
+        )
+        return [body]
+
+
+def _labels_str(labels):
+    if len(labels) == 0:
+        return ""
+
+    def escape(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{%s}" % ",".join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+
+def _error_classes(cls):
+    yield cls
+    for sub in cls.__subclasses__():
+        for c in _error_classes(sub):
+            yield c
+
+
+metrics = Metrics()
+metrics.gauge("wsjobd_sessions", "Number of jobs in sessions.", lambda: len(Job.sessions))
+metrics.gauge("wsjobd_running_jobs", "Number of jobs running in job workers.", lambda: job_executor.running)
+metrics.gauge("wsjobd_queued_jobs", "Number of jobs waiting for a job worker.", lambda: len(job_executor.queue))
+metrics.counter("wsjobd_errors_total", "Number of errors sent to clients, by error class.")
+metrics.histogram("wsjobd_job_duration_seconds", "Time a job function runs, by func.", Metrics.duration_buckets)
+metrics.histogram(
+    "wsjobd_job_queue_wait_seconds", "Time a job waits for a job worker, by priority.", Metrics.duration_buckets
+)
+metrics.histogram("wsjobd_send_latency_seconds", "Time from a frame queued to sent.", Metrics.latency_buckets)
+metrics.histogram("wsjobd_frame_bytes", "Size of frames sent.", Metrics.size_buckets)
+metrics.histogram("wsjobd_encode_seconds", "Time to encode a progress frame.", Metrics.latency_buckets)
+metrics.counter("wsjobd_jobs_cancelled_total", "Number of jobs cancelled, by reason.")
+
+for _cls in [SystemOverloadError] + list(_error_classes(JobError)):
+    metrics.inc("wsjobd_errors_total", (("err", _cls.__name__),), 0)
+
+
+class JsonCodec(object):
+    """
+    Encodes frames in json with `k3utfjson`, sent as text frames.
+
+    A codec builds a map frame from already encoded keys and values by `map`, thus a frame shared by many
+    subscriptions is never encoded again when it is tagged or batched.
+    """
+
+    name = "json"
+
+    def __init__(self):
+        self.keys = {}
+
+    def dumps(self, value):
+        return k3utfjson.dump(value)
+
+    def key(self, k):
+        encoded = self.keys.get(k)
+        if encoded is None:
+            encoded = self.keys[k] = self.dumps(k)
+        return encoded
+
+    def map(self, items):
+        return "{%s}" % ", ".join("%s: %s" % kv for kv in items)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Encodes frames in json with `orjson`, which is several times faster than `k3utfjson` for large progress.
+    A value `orjson` does not support, such as `bytes`, is encoded by `k3utfjson`.
+    """
+
+    name = "orjson"
+
+    def dumps(self, value):
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            return k3utfjson.dump(value)
+
+
+class MsgpackCodec(JsonCodec):
+    """
+    Encodes frames in MessagePack, sent as binary frames.
+    """
+
+    name = "msgpack"
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def map(self, items):
+        n = len(items)
+        if n < 16:
+            head = struct.pack(">B", 0x80 | n)
+        elif n < 0x10000:
+            head = struct.pack(">BH", 0xDE, n)
+        else:
+            head = struct.pack(">BI", 0xDF, n)
+
+        return head + b"".join(k + v for k, v in items)
+
+
+# the codecs a client can choose by `progress.codec`. "orjson" is the same as "json" on the wire, it falls back to
+# `k3utfjson` if `orjson` is not installed.
+CODECS = {"json": JsonCodec()}
+CODECS["orjson"] = OrjsonCodec() if orjson is not None else CODECS["json"]
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+
+def _encode(value, codec):
+    t0 = time.monotonic()
+    frame = codec.dumps(value)
+    metrics.observe("wsjobd_encode_seconds", time.monotonic() - t0, (("codec", codec.name),))
+    return frame
+
+
+class RequestTracer(object):
+    """
+    Records where time goes for a job request, from the message received to the first progress frame sent, see
+    `RequestTrace`. A request is traced if it has `"trace": true`, or every request is traced if `all` is true.
+    Nothing is traced until `open` is called.
+
+    Traces are written to `path` as JSON lines, one request per line:
+    `{"ident": ..., "received": <ts>, "spans": [{"name": ..., "ident": ..., "start": <ts>, "end": <ts>}, ...]}`,
+    or in the Chrome trace event format if `fmt` is `"chrome"`, which can be loaded by `chrome://tracing` or
+    Perfetto. Timestamps are of `time.monotonic()`, in seconds in JSON lines and in microseconds in Chrome format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.f = None
+        self.fmt = "jsonl"
+        self.all = False
+        self.seq = itertools.count(1)
+
+    def open(self, path, fmt="jsonl", all_requests=False):
+        if fmt not in ("jsonl", "chrome"):
+            raise ValueError("unknown trace format: %s" % fmt)
+
+        self.fmt = fmt
+        self.all = all_requests
+        if fmt == "jsonl":
+            self.f = open(path, "a")
+        else:
+            self.f = open(path, "w")
+            # the trailing "]" is optional in the array format
+            self.f.write("[\n")
+            self.f.flush()
+
+    def begin(self, msg, received_at):
+        if self.f is None:
+            return None
+
+        if not self.all and not (isinstance(msg, dict) and msg.get("trace") is True):
+            return None
+
+        ident = msg.get("ident") if isinstance(msg, dict) else None
+        return RequestTrace(self, ident, received_at)
+
+    def write(self, trace):
+        if self.fmt == "jsonl":
+            spans = [{"name": n, "ident": i, "start": s, "end": e} for n, i, s, e in trace.spans]
+            lines = [json.dumps({"ident": trace.ident, "received": trace.received_at, "spans": spans})]
+        else:
+            tid = next(self.seq)
+            lines = [
+                json.dumps(
+                    {
+                        "name": n,
+                        "cat": "wsjobd",
+                        "ph": "X",
+                        "ts": s * 1000000,
+                        "dur": (e - s) * 1000000,
+                        "pid": os.getpid(),
+                        "tid": tid,
+                        "args": {"ident": i, "request": trace.ident},
+                    }
+                )
+                + ","
+                for n, i, s, e in trace.spans
+            ]
+
+        with self.lock:
+            self.f.write("\n".join(lines) + "\n")
+            self.f.flush()
+
+
+request_tracer = RequestTracer()
+
+
+class RequestTrace(object):
+    """
+    The spans of one traced request: `jobq` waiting for a parse thread, `parse`, `check_load`, `func_lookup`,
+    `thread_start` from a job created to its function running, and `first_send` from a subscription created to its
+    first frame sent. It is written when the request is handled and every span it waits for has ended.
+    """
+
+    def __init__(self, tracer, ident, received_at):
+        self.tracer = tracer
+        self.ident = ident
+        self.received_at = received_at
+        self.lock = threading.Lock()
+        # (name, ident, start, end)
+        self.spans = []
+        # (name, ident) -> start
+        self.waiting = {}
+        self.ended = set()
+        self.closed = False
+
+    def add(self, name, start, end, ident=None):
+        with self.lock:
+            if (name, ident) in self.ended:
+                return
+
+            self.ended.add((name, ident))
+            self.waiting.pop((name, ident), None)
+            self.spans.append((name, ident, start, end))
+
+        self._flush()
+
+    @contextlib.contextmanager
+    def span(self, name, ident=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic(), ident)
+
+    def wait(self, name, ident=None):
+        """
+        Start a span that ends in another thread by `end`. The trace is not written until it ends.
+        """
+        with self.lock:
+            self.waiting[(name, ident)] = time.monotonic()
+
+    def end(self, name, ident=None):
+        with self.lock:
+            start = self.waiting.get((name, ident))
+
+        if start is not None:
+            self.add(name, start, time.monotonic(), ident)
+
+    def watch_job(self, job):
+        """
+        Record `thread_start` of a job created by this request.
+        """
+        self.wait("thread_start", job.ident)
+        job.trace = self
+
+        # the job may have started before `job.trace` is set
+        if job.started_at is not None:
+            self.add("thread_start", job.queued_at, job.started_at, job.ident)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+        self._flush()
+
+    def _flush(self):
+        with self.lock:
+            if not self.closed or len(self.waiting) > 0 or self.tracer is None:
+                return
+            tracer, self.tracer = self.tracer, None
+
+        self.spans.sort(key=lambda x: x[2])
+        tracer.write(self)
+
+
+def _span(trace, name, ident=None):
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.span(name, ident)
+
+
+class SystemLoadSampler(object):
+    """
+    Samples available memory and cpu idle percent in a background thread every `interval` seconds.
+
+    `get` returns the latest sample without blocking, thus reporting or checking system load costs nothing no
+    matter how many clients there are.
+    """
+
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.thread = None
+
+    def start(self, interval=None):
+        """
+        Take the first sample and start the sampling thread, it does nothing if already started.
+        """
+        with self.lock:
+            if interval is not None:
+                self.interval = interval
+
+            if self.thread is not None:
+                return
+
+            self.snapshot = self._sample(0.02)
+            self.thread = k3thread.daemon(target=self._loop)
+
+    def get(self):
+        if self.thread is None:
+            self.start()
+
+        return dict(self.snapshot)
+
+    def _sample(self, cpu_sample_interval):
+        return {
+            MEM_AVAILABLE: psutil.virtual_memory().available,
+            CPU_IDLE_PERCENT: psutil.cpu_times_percent(cpu_sample_interval).idle,
+        }
+
+    def _loop(self):
+        while True:
+            try:
+                # cpu usage is averaged over the entire interval
+                self.snapshot = self._sample(self.interval)
+            except Exception as e:
+                logger.exception("failed to sample system load: %s" % repr(e))
+                time.sleep(self.interval)
+
+
+system_load_sampler = SystemLoadSampler()
+
+
+class JobRegistry(object):
+    """
+    Resolves job functions by `(jobs_dir, func)` and caches them, so that the request path does not import.
+
+    A module is reloaded when the mtime of its file changes, which is checked at most once every
+    `check_interval` seconds. Thus a job module can be updated without restarting wsjobd.
+    """
+
+    def __init__(self, check_interval=1):
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+
+        # mod_path -> [module, mtime, last_checked, generation]
+        self.modules = {}
+        # (jobs_dir, func) -> (mod_path, func, generation)
+        self.funcs = {}
+
+    def get(self, jobs_dir, func):
+        key = (jobs_dir, func)
+        cached = self.funcs.get(key)
+
+        if cached is not None:
+            mod_path, f, generation = cached
+            if self._module(mod_path)[3] == generation:
+                return f
+
+        mod_func = jobs_dir.split("/") + func.split(".")
+        mod_path = ".".join(mod_func[:-1])
+        func_name = mod_func[-1]
+
+        mod, _, _, generation = self._module(mod_path)
+
+        try:
+            f = getattr(mod, func_name)
+        except AttributeError:
+            raise LoadingError("function not found: " + repr(func_name))
+
+        self.funcs[key] = (mod_path, f, generation)
+        return f
+
+    def preload(self, jobs_dir=JOBS_DIR):
+        """
+        Import every module under `jobs_dir`. A module failed to import is logged and skipped.
+        """
+        pkg = self._module(".".join(jobs_dir.split("/")))[0]
+
+        for _, mod_path, _ in pkgutil.walk_packages(pkg.__path__, prefix=pkg.__name__ + "."):
+            try:
+                self._module(mod_path)
+            except LoadingError as e:
+                logger.error("failed to preload job module %s: %s" % (mod_path, repr(e)))
+
+    def _module(self, mod_path):
+        now = time.monotonic()
+        entry = self.modules.get(mod_path)
+
+        if entry is not None and now - entry[2] < self.check_interval:
+            return entry
+
+        with self.lock:
+            entry = self.modules.get(mod_path)
+
+            try:
+                if entry is None:
+                    mod = importlib.import_module(mod_path)
+                    entry = [mod, _mtime(mod), now, 0]
+                    self.modules[mod_path] = entry
+                    logger.info("mod imported from: " + repr(mod.__file__))
+                    return entry
+
+                mtime = _mtime(entry[0])
+                if mtime != entry[1]:
+                    importlib.reload(entry[0])
+                    entry[1] = mtime
+                    entry[3] += 1
+                    logger.info("mod reloaded from: " + repr(entry[0].__file__))
+
+            except (ImportError, SyntaxError) as e:
+                raise LoadingError("failed to import %s: %s" % (mod_path, repr(e)))
+
+            entry[2] = now
+            return entry
+
+
+def _mtime(mod):
+    path = getattr(mod, "__file__", None)
+    if path is None:
+        return None
+
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+job_registry = JobRegistry()
+
+
+class JobExecutor(object):
+    """
+    Runs `Job.work` in at most `max_workers` threads, `None` means no limit.
+
+    Jobs submitted when all workers are busy wait in a queue of at most `max_queue` jobs, a job submitted to a
+    full queue is rejected with `SystemOverloadError`. A worker thread runs queued jobs one by one until the queue
+    is empty.
+
+    Queued jobs are scheduled with weighted fair queuing among tenants: a job is tagged with a virtual finish time
+    `max(vtime, the tag of the last queued job of the tenant) + 1 / job.priority`, and the job with the least tag
+    runs first. Thus a tenant flooding jobs only delays its own jobs, and a job with a greater priority overtakes
+    jobs of less priority.
+
+    The time every job waits in queue is accounted per priority, see `wait_stats`.
+    """
+
+    def __init__(self, max_workers=None, max_queue=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+
+        self.lock = threading.Lock()
+        self.running = 0
+        # (tag, seq, job)
+        self.queue = []
+        # job -> its position in queue, built on demand and dropped when the queue changes
+        self.ranks = None
+        self.seq = itertools.count()
+        self.vtime = 0
+        # tenant -> the tag of its last queued job
+        self.tenant_tags = {}
+        # priority -> [count, total wait time, max wait time]
+        self.waits = {}
+
+    def submit(self, job, force=False):
+        """
+        Run `job` or queue it. It raises `SystemOverloadError` if the queue is full, unless `force` is true.
+        """
+        with self.lock:
+            if self.max_workers is None or self.running < self.max_workers:
+                self.running += 1
+                self._start(job)
+                k3thread.daemon(target=self._run, args=(job,))
+                return
+
+            if not force and self.max_queue is not None and len(self.queue) >= self.max_queue:
+                raise SystemOverloadError("job queue is full: %d jobs queued" % len(self.queue))
+
+            tag = max(self.vtime, self.tenant_tags.get(job.tenant, 0)) + 1.0 / job.priority
+            self.tenant_tags[job.tenant] = tag
+            job.queue_key = (tag, next(self.seq))
+            heapq.heappush(self.queue, job.queue_key + (job,))
+            self.ranks = None
+
+        logger.info("job %s queued, there are %d jobs in queue now" % (job.ident, len(self.queue)))
+
+    def check(self, n):
+        """
+        Raise `SystemOverloadError` if `n` more jobs could not be run or queued at once.
+        """
+        if self.max_workers is None or self.max_queue is None:
+            return
+
+        with self.lock:
+            free = self.max_workers - self.running + self.max_queue - len(self.queue)
+            if n > free:
+                raise SystemOverloadError("job queue is full: %d jobs queued, %d more" % (len(self.queue), n))
+
+    def position(self, job):
+        """
+        The 1-based position of a queued job, or `None` if it is not in queue. All of the queued jobs are ranked
+        once until the queue changes, thus reporting the positions of all of them costs O(n log n).
+        """
+        with self.lock:
+            if job.status != JOB_QUEUED or job.queue_key is None:
+                return None
+
+            if self.ranks is None:
+                self.ranks = dict((e[2], i + 1) for i, e in enumerate(sorted(self.queue)))
+
+            return self.ranks.get(job)
+
+    def wait_stats(self):
+        """
+        The time jobs waited in queue, a dict of priority to a dict of `count`, `total` and `max` in seconds.
+        """
+        with self.lock:
+            return {p: {"count": c, "total": total, "max": mx} for p, (c, total, mx) in self.waits.items()}
+
+    def _start(self, job):
+        job.status = JOB_RUNNING
+        job.queue_key = None
+
+        wait = time.monotonic() - job.queued_at
+        stat = self.waits.setdefault(job.priority, [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += wait
+        stat[2] = max(stat[2], wait)
+        metrics.observe("wsjobd_job_queue_wait_seconds", wait, (("priority", job.priority),))
+
+    def _pop(self):
+        tag, _, job = heapq.heappop(self.queue)
+        self.ranks = None
+        self.vtime = tag
+
+        # the tenant has no more jobs in queue
+        if self.tenant_tags.get(job.tenant) == tag:
+            del self.tenant_tags[job.tenant]
+
+        return job
+
+    def _run(self, job):
+        while job is not None:
+            job.thread = threading.current_thread()
+            job.work()
+
+            with self.lock:
+                if len(self.queue) > 0:
+                    job = self._pop()
+                    self._start(job)
+                else:
+                    self.running -= 1
+                    job = None
+                    continue
+
+            # let the subscribers know the job is no more queued
+            progress_scheduler.wake(job)
+
+
+job_executor = JobExecutor()
+
+
+class CoroutineJobRunner(object):
+    """
+    Runs `async def run(job)` job functions cooperatively on one asyncio event loop in a dedicated thread.
+
+    A coroutine job costs no thread, and is not limited by `JobExecutor`. It must not block, e.g., it should use
+    `await asyncio.sleep()` instead of `time.sleep()`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        # the loop keeps only weak references to tasks, a task waiting for a stream would be garbage collected
+        self.tasks = set()
+
+    def submit(self, job):
+        loop = self._get_loop()
+
+        job.status = JOB_RUNNING
+        job.thread = self.thread
+        loop.call_soon_threadsafe(self._start, job)
+
+    def _start(self, job):
+        task = self.loop.create_task(job.work_async())
+        job.task = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def cancel(self, job):
+        self.loop.call_soon_threadsafe(self._cancel, job)
+
+    def _cancel(self, job):
+        # a task cancelled before it starts never runs `work_async` thus never ends, it checks `job.cancelled` instead
+        if job.task is not None and job.started_at is not None:
+            job.task.cancel()
+
+    def _get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = k3thread.daemon(target=self._run, args=(self.loop,))
+
+            return self.loop
+
+    def _run(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+
+coroutine_job_runner = CoroutineJobRunner()
+
+
+def process_job(func):
+    """
+    Mark a job function to run in the process pool, the same as `"process": true` in the job message.
+
+    The function must be defined at module level, it receives a job that has only `ident`, `data`, `ctx`,
+    `cancelled`, `report` and `update`. Changes to `job.data` are sent back to wsjobd periodically, and the entire
+    `job.data` when it returns.
+    """
+    func.wsjobd_process = True
+    return func
+
+
+class ProcessJobPool(object):
+    """
+    Runs job functions in a pool of `max_workers` processes, thus cpu bound jobs do not contend for the GIL with
+    wsjobd. `None` means the number of cpus.
+
+    A job function running in a child process has its `job.data` diffed every `flush_interval` seconds. The changed
+    keys are sent back through a queue shared by all children, and merged into `job.data` of the parent, so progress
+    reporting works the same as with a thread job. As in a merge-patch, a key set to `None` is removed.
+
+    `job.cancelled` of a child is an event of a `multiprocessing.Manager`, set by `cancel`.
+    """
+
+    def __init__(self, max_workers=None, flush_interval=0.1):
+        self.max_workers = max_workers
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+        self.pool = None
+        self.queue = None
+        self.reader = None
+
+        self.manager = None
+
+        self.seq = itertools.count()
+        self.jobs = {}
+        # token -> the `cancelled` event of the job in a child
+        self.cancels = {}
+
+    def run(self, func, job):
+        token = next(self.seq)
+        pool = self._get_pool()
+        cancelled = self.manager.Event()
+
+        with self.lock:
+            self.jobs[token] = job
+            self.cancels[token] = cancelled
+
+        # cancelled before `cancel` could find it
+        if job.cancelled.is_set():
+            cancelled.set()
+
+        try:
+            future = pool.submit(
+                _process_job_run, token, func, job.ident, dict(job.data), self.flush_interval, cancelled
+            )
+            data = future.result()
+        except BrokenProcessPool:
+            with self.lock:
+                if self.pool is pool:
+                    self.pool = None
+            raise
+        finally:
+            with self.lock:
+                del self.jobs[token]
+                del self.cancels[token]
+
+        # patches still in queue are dropped since the job is removed
+        _apply_patch(job.data, data)
+        for k in list(job.data.keys()):
+            if k not in data:
+                del job.data[k]
+
+    def cancel(self, job):
+        """
+        Set `job.cancelled` in the child running `job`, it does nothing if `job` is not a running process job.
+        """
+        with self.lock:
+            events = [self.cancels[token] for token, j in self.jobs.items() if j is job]
+
+        for ev in events:
+            ev.set()
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # fork a process with threads running is not safe
+                ctx = multiprocessing.get_context("spawn")
+
+                if self.queue is None:
+                    self.queue = ctx.Queue()
+                    self.manager = ctx.Manager()
+                    self.reader = k3thread.daemon(target=self._read)
+
+                self.pool = ProcessPoolExecutor(
+                    self.max_workers,
+                    mp_context=ctx,
+                    initializer=_process_job_init,
+                    initargs=(self.queue,),
+                )
+
+            return self.pool
+
+    def _read(self):
+        while True:
+            token, patch = self.queue.get()
+
+            with self.lock:
+                job = self.jobs.get(token)
+                if job is not None:
+                    _apply_patch(job.data, patch)
+
+
+def _apply_patch(data, patch):
+    for k, v in patch.items():
+        if v is None:
+            data.pop(k, None)
+        else:
+            data[k] = v
+
+
+class _ProcessJob(object):
+    def __init__(self, ident, data, cancelled):
+        self.ident = ident
+        self.data = data
+        self.ctx = {}
+        self.cancelled = cancelled
+
+    def report(self, **fields):
+        self.data.update(fields)
+
+    def update(self):
+        # changes of `job.data` are sent back every `flush_interval` seconds anyway
+        pass
+
+
+_process_job_queue = None
+
+
+def _process_job_init(queue):
+    global _process_job_queue
+    _process_job_queue = queue
+
+
+def _process_job_run(token, func, ident, data, flush_interval, cancelled):
+    job = _ProcessJob(ident, data, cancelled)
+    delta = DeltaState()
+    delta.update(data)
+    stopped = threading.Event()
+
+    def flush():
+        while not stopped.wait(flush_interval):
+            try:
+                # the job function changes `job.data` in another thread, diff a copy of it
+                data = job.data
+                if isinstance(data, dict):
+                    data = dict(data)
+
+                version = delta.version
+                delta.update(data)
+                if delta.version != version:
+                    _process_job_queue.put((token, delta.patch))
+
+            except Exception as e:
+                logger.info("failed to flush progress of process job %s: %s" % (ident, repr(e)))
+
+    flusher = k3thread.daemon(target=flush)
+    try:
+        func(job)
+    finally:
+        stopped.set()
+        flusher.join()
+
+    return job.data
+
+
+process_job_pool = ProcessJobPool()
+
+
+class JobResultCache(object):
+    """
+    Keeps at most `size` finished jobs with their final `data` and `err` for `ttl` seconds, the least recently used
+    one is evicted first. A request with the ident of a cached job gets the final result at once, instead of running
+    the job again. `size` 0 disables the cache.
+    """
+
+    def __init__(self, size=0, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+
+    def put(self, job):
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            self.jobs.pop(job.ident, None)
+            self.jobs[job.ident] = (job, time.monotonic() + self.ttl)
+
+            while len(self.jobs) > self.size:
+                self.jobs.popitem(last=False)
+
+    def get(self, ident):
+        with self.lock:
+            cached = self.jobs.get(ident)
+            if cached is None:
+                return None
+
+            job, expire_at = cached
+            if expire_at < time.monotonic():
+                del self.jobs[ident]
+                return None
+
+            self.jobs.move_to_end(ident)
+            return job
+
+
+job_result_cache = JobResultCache()
+
+
+class JobJournal(object):
+    """
+    A durable journal of running jobs, enabled by `run(journal_dir)`, thus jobs survive a restart of wsjobd.
+
+    Every job has an append-only file of json lines in `dir`. The first line is
+    `{"op": "start", "msg": <job description>, "jobs_dir": ...}`, followed by `{"op": "snapshot", "data": ...}`
+    written every `interval` seconds if `job.data` has changed, and `{"op": "checkpoint", "data": ..., "state": ...}`
+    written by `job.checkpoint(state)`. A file larger than `max_size` is compacted to its start line, the last
+    checkpoint and the last line. The file is removed when the job ends.
+
+    On start, every job left in `dir` is run again with `job.restored` set to the `state` of its last checkpoint and
+    `job.data` of the same checkpoint, or of its last line if there is no checkpoint. `ident` and `func` are always
+    those of the start line. A client re-attaches to it by sending the same `ident`. A torn last line, written while
+    crashing, is ignored. A journal failing to resume is renamed to `<name>.failed`. Relay jobs of `WorkerCluster`
+    are not journaled.
+    """
+
+    def __init__(self, interval=5, max_size=1024 * 1024):
+        self.dir = None
+        self.interval = interval
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        # ident -> [file, start line, last checkpoint line, last data, lines not yet written]
+        self.journals = {}
+
+    def enabled(self):
+        return self.dir is not None
+
+    def init(self, dir_):
+        os.makedirs(dir_, exist_ok=True)
+        self.dir = dir_
+        k3thread.daemon(target=self._loop)
+
+    def open(self, job, records=None):
+        """
+        Start the journal of `job`, or continue `records` of the journal it is resumed from. It is called with
+        `Job.lock` held, thus it does not touch the disk. The journal is written by `sync` when the job starts, or by
+        the next `write`, whichever is the first.
+        """
+        if self.dir is None or job.owner is not None:
+            return
+
+        if records is None:
+            records = [{"op": "start", "msg": job.data, "jobs_dir": job.jobs_dir}]
+
+        lines = [k3utfjson.dump(r) for r in records]
+        checkpoint = None
+        for r, line in zip(records, lines):
+            if r["op"] == "checkpoint":
+                job.restored = r["state"]
+                checkpoint = line
+
+        with self.lock:
+            self.journals[job.ident] = [None, lines[0], checkpoint, None, lines]
+
+    def sync(self, job):
+        """
+        Write the journal of `job` to disk if it is not yet.
+        """
+        with self.lock:
+            journal = self.journals.get(job.ident)
+            if journal is not None:
+                self._sync(job.ident, journal)
+
+    def write(self, job, op="snapshot", state=None):
+        with self.lock:
+            journal = self.journals.get(job.ident)
+            if journal is None:
+                return
+
+            self._sync(job.ident, journal)
+
+            try:
+                data = k3utfjson.dump(job.data)
+                if op == "snapshot" and data == journal[3]:
+                    return
+
+                record = {"op": op, "data": job.data}
+                if op == "checkpoint":
+                    record["state"] = state
+                line = k3utfjson.dump(record)
+
+            # `job.data` could be changed by the job while dumping it
+            except (TypeError, ValueError, RuntimeError) as e:
+                logger.info("failed to dump job %s to journal: %s" % (job.ident, repr(e)))
+                return
+
+            f = journal[0]
+            f.write((line + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+            journal[3] = data
+            if op == "checkpoint":
+                journal[2] = line
+
+            if f.tell() > self.max_size:
+                f.close()
+                lines = [journal[1]] + [x for x in (journal[2], line) if x is not None]
+                journal[0] = self._rewrite(job.ident, list(OrderedDict.fromkeys(lines)))
+
+    def close(self, job):
+        with self.lock:
+            journal = self.journals.pop(job.ident, None)
+            if journal is None:
+                return
+
+            if journal[0] is not None:
+                journal[0].close()
+
+            # the journal of a job ended before `sync` is not written, or is still the one it is resumed from
+            try:
+                os.unlink(self._path(job.ident))
+            except FileNotFoundError:
+                pass
+
+    def resume(self):
+        """
+        Run every job left in the journal again, it is called before serving.
+        """
+        for name in sorted(os.listdir(self.dir)):
+            if not name.endswith(".journal"):
+                continue
+
+            path = os.path.join(self.dir, name)
+            ident = None
+
+            try:
+                records = self._read(path)
+                if len(records) == 0 or records[0].get("op") != "start":
+                    raise LoadingError("no start in journal")
+
+                start = records[0]
+                ident = start["msg"]["ident"]
+
+                # data and the state restored must be of the same moment
+                checkpoints = [r for r in records if r.get("op") == "checkpoint"]
+                data = (checkpoints or records)[-1].get("data")
+                if not isinstance(data, dict):
+                    data = start["msg"]
+                msg = dict(data, ident=ident, func=start["msg"]["func"])
+
+                if worker_cluster.enabled() and worker_cluster.claim(ident) is not None:
+                    logger.info("job %s in journal %s is run by another worker" % (ident, path))
+                    os.unlink(path)
+                    continue
+
+                func = _process_func(start["msg"], job_registry.get(start["jobs_dir"], start["msg"]["func"]))
+
+                # a resumed job is not subject to admission or the job queue size, it was admitted before restart
+                with Job.lock:
+                    Job(None, msg, func, jobs_dir=start["jobs_dir"], journal=records)
+
+            except Exception as e:
+                # keep the checkpointed work, but do not try it again
+                logger.error("failed to resume job from journal %s: %s" % (path, repr(e)))
+                try:
+                    os.replace(path, path + ".failed")
+                except OSError:
+                    pass
+                if worker_cluster.enabled() and ident is not None:
+                    worker_cluster.release(ident)
+                continue
+
+            logger.info("resumed job %s from journal %s" % (ident, path))
+
+    def _read(self, path):
+        records = []
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    records.append(k3utfjson.load(line.decode("utf-8")))
+                except ValueError:
+                    break
+
+        return records
+
+    def _sync(self, ident, journal):
+        if journal[0] is None:
+            journal[0] = self._rewrite(ident, journal[4])
+            journal[4] = None
+
+    def _rewrite(self, ident, lines):
+        path = self._path(ident)
+        with open(path + ".tmp", "wb") as f:
+            f.write("".join(x + "\n" for x in lines).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(path + ".tmp", path)
+        return open(path, "ab")
+
+    def _path(self, ident):
+        name = hashlib.md5(k3utfjson.dump(ident).encode("utf-8")).hexdigest()
+        return os.path.join(self.dir, name + ".journal")
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+
+            with Job.lock:
+                jobs = list(Job.sessions.values())
+
+            for job in jobs:
+                try:
+                    self.write(job)
+                except OSError as e:
+                    logger.error("failed to write journal of job %s: %s" % (job.ident, repr(e)))
+
+
+job_journal = JobJournal()
+
+
+class OrphanReaper(object):
+    """
+    Cancels orphaned jobs, if `grace` is not `None`.
+
+    A job is orphaned when its last subscriber has gone, i.e., all of its subscriptions are closed and no relay job
+    of another worker mirrors it. It is cancelled with `job.cancel("orphaned")` if no client subscribes it again in
+    `grace` seconds. A job never subscribed, such as one submitted with `"progress": false`, is never orphaned.
+    """
+
+    def __init__(self, grace=None, check_interval=1):
+        self.grace = grace
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.grace is None or self.thread is not None:
+                return
+            self.thread = k3thread.daemon(target=self._loop)
+
+    def reap(self):
+        now = time.monotonic()
+
+        with Job.lock:
+            jobs = [
+                job
+                for job in Job.sessions.values()
+                if job.orphaned_at is not None and now - job.orphaned_at >= self.grace
+            ]
+
+        for job in jobs:
+            job.cancel("orphaned")
+
+    def _loop(self):
+        while True:
+            time.sleep(self.check_interval)
+            self.reap()
+
+
+orphan_reaper = OrphanReaper()
+
+
+class AdmissionPolicy(object):
+    """
+    Server side limits on new jobs, no matter what thresholds a client puts in `check_load`. A job attaching to an
+    existing ident is not a new job. A rejected job raises `SystemOverloadError`.
+
+    - `max_jobs`: the max number of jobs in sessions, running or queued.
+    - `max_jobs_per_func`: the max number of jobs of one `func`, either a number for every `func`, or a dict of
+      `func` to number.
+    - `rate` and `burst`: a token bucket limits new jobs to `rate` per second with bursts of `burst`, per tenant.
+      `burst` is at least 1, the default is `max(1, rate)`.
+      The tenant is the `tenant_field` of the job message if it is set, otherwise the remote address.
+
+    `None` means no limit.
+    """
+
+    limits = ("max_jobs", "max_jobs_per_func", "rate", "burst", "tenant_field")
+    max_buckets = 10000
+
+    def __init__(self, max_jobs=None, max_jobs_per_func=None, rate=None, burst=None, tenant_field=None):
+        self.max_jobs = max_jobs
+        self.max_jobs_per_func = max_jobs_per_func
+        self.rate = rate
+        self.burst = burst
+        self.tenant_field = tenant_field
+
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.jobs_per_func = {}
+        # tenant -> [tokens, last refill time]
+        self.buckets = {}
+
+    def admit(self, channel, msg, force=False):
+        """
+        Count a new job, or raise `SystemOverloadError` if it exceeds a limit. A job is counted without checking
+        limits if `force` is true.
+        """
+        func = msg.get("func")
+
+        with self.lock:
+            if force:
+                self.jobs += 1
+                self.jobs_per_func[func] = self.jobs_per_func.get(func, 0) + 1
+                return
+
+            if self.max_jobs is not None and self.jobs >= self.max_jobs:
+                raise SystemOverloadError("too many jobs: %d" % self.jobs)
+
+            func_limit = self.max_jobs_per_func
+            if isinstance(func_limit, dict):
+                func_limit = func_limit.get(func)
+
+            n = self.jobs_per_func.get(func, 0)
+            if func_limit is not None and n >= func_limit:
+                raise SystemOverloadError("too many jobs of %s: %d" % (func, n))
+
+            if self.rate is not None:
+                tenant = self.tenant(channel, msg)
+                if not self._take_token(tenant):
+                    raise SystemOverloadError("too many new jobs from %s" % tenant)
+
+            self.jobs += 1
+            self.jobs_per_func[func] = n + 1
+
+    def check(self, channel, msgs):
+        """
+        Raise `SystemOverloadError` if admitting all of the new jobs `msgs` at once would exceed a limit. Nothing is
+        counted, see `admit`.
+        """
+        per_func = {}
+        per_tenant = {}
+        for msg in msgs:
+            per_func[msg.get("func")] = per_func.get(msg.get("func"), 0) + 1
+            if self.rate is not None:
+                tenant = self.tenant(channel, msg)
+                per_tenant[tenant] = per_tenant.get(tenant, 0) + 1
+
+        with self.lock:
+            if self.max_jobs is not None and self.jobs + len(msgs) > self.max_jobs:
+                raise SystemOverloadError("too many jobs: %d + %d" % (self.jobs, len(msgs)))
+
+            for func, n in per_func.items():
+                func_limit = self.max_jobs_per_func
+                if isinstance(func_limit, dict):
+                    func_limit = func_limit.get(func)
+
+                running = self.jobs_per_func.get(func, 0)
+                if func_limit is not None and running + n > func_limit:
+                    raise SystemOverloadError("too many jobs of %s: %d + %d" % (func, running, n))
+
+            burst = self.burst or max(1, self.rate or 0)
+            now = time.monotonic()
+            for tenant, n in per_tenant.items():
+                bucket = self.buckets.get(tenant)
+                tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * self.rate)
+                if tokens < n:
+                    raise SystemOverloadError("too many new jobs from %s" % tenant)
+
+    def release(self, job):
+        with self.lock:
+            self.jobs -= 1
+            self.jobs_per_func[job.func_name] -= 1
+            if self.jobs_per_func[job.func_name] == 0:
+                del self.jobs_per_func[job.func_name]
+
+    def tenant(self, channel, msg):
+        if self.tenant_field is not None and msg.get(self.tenant_field) is not None:
+            return msg[self.tenant_field]
+
+        environ = getattr(getattr(channel, "ws", None), "environ", None) or {}
+        return environ.get("REMOTE_ADDR")
+
+    def _take_token(self, tenant):
+        # a bucket must hold a whole token, or no job is ever admitted
+        burst = self.burst or max(1, self.rate)
+        now = time.monotonic()
+
+        bucket = self.buckets.get(tenant)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self._prune(now, burst)
+            bucket = self.buckets[tenant] = [burst, now]
+
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        if bucket[0] < 1:
+            return False
+
+        bucket[0] -= 1
+        return True
+
+    def _prune(self, now, burst):
+        # a full bucket is the same as a new one
+        for tenant, (tokens, last) in list(self.buckets.items()):
+            if tokens + (now - last) * self.rate >= burst:
+                del self.buckets[tenant]
+
+
+admission_policy = AdmissionPolicy()
+
+
+class WorkerCluster(object):
+    """
+    The worker processes of `run(workers=N)`, they accept connections on the same port with `SO_REUSEPORT`.
+
+    A job ident is claimed by the worker that creates the job, in a SQLite database shared by the workers. Another
+    worker that gets a request for a claimed ident creates a relay job instead, which mirrors `job.data` of the
+    owner through a unix socket of the owner, thus the job runs only once in all workers. A claim is released when
+    the job ends, a claim of a dead worker is taken over.
+
+    The relay protocol is json lines. The relay job sends `{"ident": ...}`, the owner replies with
+    `{"data": <job.data>}` every time `job.data` changes, checked every `relay_interval` seconds, and finally
+    `{"data": <job.data>, "end": true, "err": null or [<exception class name>, <exception args>]}`, or
+    `{"missing": true}` if the job is no longer in sessions or result cache of the owner.
+
+    A dead worker is restarted after `restart_delay` seconds, doubled every time it dies again within
+    `min_uptime` seconds after start, up to `max_restart_delay`. If a worker dies so `max_quick_deaths` times in a
+    row, all workers are stopped and wsjobd exits with status 1.
+    """
+
+    relay_interval = 0.1
+    restart_delay = 0.5
+    max_restart_delay = 30
+    min_uptime = 10
+    max_quick_deaths = 5
+
+    def __init__(self):
+        self.index = None
+        self.dir = None
+        self.local = threading.local()
+
+    def enabled(self):
+        return self.index is not None
+
+    def init(self, dir_):
+        self.dir = dir_
+        with contextlib.closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS claims (ident TEXT PRIMARY KEY, worker INTEGER, pid INTEGER)")
+
+    def claim(self, ident):
+        """
+        Claim `ident` for this worker. It returns `None` if this worker owns it, or the index of the owner.
+        """
+        db = self._db()
+        key = k3utfjson.dump(ident)
+
+        while True:
+            cur = db.execute("INSERT OR IGNORE INTO claims VALUES (?, ?, ?)", (key, self.index, os.getpid()))
+            if cur.rowcount == 1:
+                return None
+
+            row = db.execute("SELECT worker, pid FROM claims WHERE ident = ?", (key,)).fetchone()
+            if row is None:
+                # released just now
+                continue
+
+            worker, pid = row
+            if pid == os.getpid():
+                return None
+
+            if psutil.pid_exists(pid):
+                return worker
+
+            logger.info("take over job %s claimed by dead worker %d" % (ident, worker))
+            db.execute("DELETE FROM claims WHERE ident = ? AND pid = ?", (key, pid))
+
+    def owner(self, ident):
+        row = self._db().execute("SELECT worker FROM claims WHERE ident = ?", (k3utfjson.dump(ident),)).fetchone()
+        return None if row is None else row[0]
+
+    def release(self, ident):
+        self._db().execute(
+            "DELETE FROM claims WHERE ident = ? AND pid = ?",
+            (k3utfjson.dump(ident), os.getpid()),
+        )
+
+    def relay(self, owner):
+        """
+        The job function mirroring the job of `owner`.
+        """
+        func = functools.partial(_relay_job, self.socket_path(owner))
+        func.wsjobd_owner = owner
+        return func
+
+    def socket_path(self, index):
+        return os.path.join(self.dir, "worker-%d.sock" % index)
+
+    def serve(self):
+        path = self.socket_path(self.index)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(128)
+
+        gevent.server.StreamServer(sock, self._handle).start()
+
+    def _handle(self, sock, address):
+        f = sock.makefile("rwb")
+        job = None
+
+        try:
+            ident = k3utfjson.load(f.readline())["ident"]
+
+            with Job.lock:
+                job = Job.sessions.get(ident) or job_result_cache.get(ident)
+
+            # a relay job is never relayed again
+            if job is None or job.owner is not None:
+                f.write(b'{"missing": true}\n')
+                f.flush()
+                return
+
+            # the clients of the relay job are subscribers of this job too
+            job.attach_relay()
+
+            last = None
+            while True:
+                ended = job.ended.is_set()
+
+                data = job.data
+                if isinstance(data, dict):
+                    data = dict(data)
+                encoded = k3utfjson.dump(data)
+
+                if ended:
+                    f.write(('{"data": %s, "end": true, "err": %s}\n' % (encoded, self._err(job))).encode("utf-8"))
+                    f.flush()
+                    return
+
+                if encoded != last:
+                    f.write(('{"data": %s}\n' % encoded).encode("utf-8"))
+                    f.flush()
+                    last = encoded
+
+                # the relay job sends nothing more, a readable socket means it has gone
+                readable, _, _ = gevent.select.select([sock], [], [], self.relay_interval)
+                if readable and not sock.recv(1):
+                    return
+
+        except (OSError, ValueError, KeyError) as e:
+            logger.info("relay of worker %s is broken: %s" % (self.index, repr(e)))
+
+        finally:
+            if job is not None and job.owner is None:
+                job.detach_relay()
+            f.close()
+            sock.close()
+
+    def _err(self, job):
+        err = job.err
+        if err is None:
+            return "null"
+
+        name = err.name if isinstance(err, RemoteJobError) else err.__class__.__name__
+        try:
+            return k3utfjson.dump([name, err.args])
+        except (TypeError, ValueError):
+            return k3utfjson.dump([name, [repr(a) for a in err.args]])
+
+    def _db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = self._connect()
+        return db
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.dir, "sessions.db"), timeout=10, isolation_level=None)
+
+
+worker_cluster = WorkerCluster()
+
+
+class HashRing(object):
+    """
+    A consistent hash ring of nodes, every node is placed on the ring `replicas` times. Adding or removing a node
+    moves only the idents of that node.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        points = sorted((_hash("%s#%d" % (node, i)), node) for node in nodes for i in range(replicas))
+        self.keys = [p[0] for p in points]
+        self.nodes = [p[1] for p in points]
+
+    def owner(self, ident):
+        if len(self.keys) == 0:
+            return None
+
+        i = bisect.bisect(self.keys, _hash(k3utfjson.dump(ident))) % len(self.keys)
+        return self.nodes[i]
+
+
+def _hash(s):
+    return int(hashlib.md5(s.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class ClusterRouter(object):
+    """
+    Routes job requests of a cluster of wsjobd nodes, a node is named by its websocket address `"host:port"`.
+
+    The owner of an ident is found on a `HashRing` of all nodes. A request for an ident owned by another node is
+    proxied to the owner by a `NodeProxy`, or if `redirect` is true, replied with `{"redirect": "host:port"}`,
+    which is tagged with the ident in multiplex mode.
+
+    A proxied request carries `"routed_by": <node>`, it is always handled by the node that receives it, thus nodes
+    with different views of the ring never route a request in circles. A batch is never routed, a batch with a job
+    owned by another node is rejected with `RoutingError("...", [[<ident>, <owner node>], ...])`, the client should
+    submit the jobs to their owners.
+    """
+
+    def __init__(self):
+        self.node = None
+        self.ring = HashRing()
+        self.redirect = False
+
+    def configure(self, node, nodes, replicas=100, redirect=False):
+        if node not in nodes:
+            raise ValueError("node %s is not in cluster nodes: %s" % (node, nodes))
+
+        if not redirect and websocket is None:
+            raise ValueError("proxying to cluster nodes requires websocket-client")
+
+        self.node = node
+        self.ring = HashRing(nodes, replicas)
+        self.redirect = redirect
+
+    def route(self, msg):
+        """
+        The node to route `msg` to, or `None` if it is handled by this node.
+        """
+        if self.node is None or msg.get("routed_by") is not None:
+            return None
+
+        owner = self.ring.owner(msg.get("ident"))
+        if owner == self.node:
+            return None
+
+        return owner
+
+
+cluster_router = ClusterRouter()
+
+
+class NodeProxy(object):
+    """
+    Sends a request to the node owning the ident, and forwards every frame of the node to `channel` as is, in a
+    thread of its own.
+
+    In legacy mode, the connection to the client is closed when the node closes the connection. In multiplex mode
+    the request is a command sent after the hello `{"multiplex": true}`, and the proxy ends after a terminal frame,
+    which is recognized only in json.
+    """
+
+    connect_timeout = 5
+
+    def __init__(self, channel, node, msg):
+        self.channel = channel
+        self.node = node
+        self.msg = dict(msg, routed_by=cluster_router.node)
+        self.ident = msg.get("ident")
+        self.multiplex = channel.multiplex
+        self.ws = None
+        self.closed = False
+
+    def start(self):
+        k3thread.daemon(target=self._run)
+
+    def send(self, message):
+        ws = self.ws
+        if ws is not None:
+            ws.send(message)
+
+    def close(self):
+        self.closed = True
+
+        ws = self.ws
+        if ws is not None:
+            # do not wait for the close handshake
+            ws.shutdown()
+
+    def _run(self):
+        channel = self.channel
+
+        try:
+            try:
+                self.ws = websocket.create_connection("ws://%s/" % self.node, timeout=self.connect_timeout)
+            except (OSError, websocket.WebSocketException) as e:
+                raise RoutingError("failed to connect to node %s: %s" % (self.node, repr(e)))
+
+            if self.closed:
+                self.ws.shutdown()
+                return
+
+            self.ws.settimeout(None)
+            if self.multiplex:
+                self.ws.send(k3utfjson.dump({"multiplex": True}))
+            self.ws.send(k3utfjson.dump(self.msg))
+
+            while True:
+                frame = self.ws.recv()
+                if not frame:
+                    break
+
+                channel._send(frame)
+
+                if self.multiplex and self._is_terminal(frame):
+                    self.ws.close()
+                    break
+
+        except RoutingError as e:
+            logger.info("error on channel %s while routing, %s" % (repr(channel), repr(e)))
+            if self.multiplex:
+                channel._send_err(e, self.ident)
+            else:
+                channel._send_err_and_close(e)
+
+        except (OSError, websocket.WebSocketException) as e:
+            if not self.closed:
+                logger.info("connection to node %s is broken: %s" % (self.node, repr(e)))
+
+        finally:
+            with Job.lock:
+                if self in channel.proxies:
+                    channel.proxies.remove(self)
+
+            if not self.multiplex and not self.closed:
+                channel._send(None, close=True)
+
+    def _is_terminal(self, frame):
+        if not isinstance(frame, str):
+            return False
+
+        try:
+            frame = k3utfjson.load(frame).get("frame")
+        except (ValueError, AttributeError):
+            return False
+
+        return isinstance(frame, dict) and (frame.get("status") in (JOB_DONE, "error") or "err" in frame)
+
+
+async def _relay_job(path, job):
+    reader, writer = await asyncio.open_unix_connection(path, limit=2**26)
+
+    try:
+        writer.write((k3utfjson.dump({"ident": job.ident}) + "\n").encode("utf-8"))
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise RemoteJobError("RelayError", "the worker running the job has gone")
+
+            msg = k3utfjson.load(line)
+            if msg.get("missing"):
+                raise JobNotInSessionError("job not in sessions of the owner: " + repr(job.ident))
+
+            job.data = msg["data"]
+            job.update()
+
+            if msg.get("end"):
+                if msg["err"] is not None:
+                    raise RemoteJobError(msg["err"][0], *msg["err"][1])
+                return
+    finally:
+        writer.close()
+
+
+class Job(object):
+    lock = threading.RLock()
+    sessions = {}
+
+    def __init__(self, channel, msg, func, jobs_dir=JOBS_DIR, journal=None):
+        """
+        Job description is a string formatted in json, it is used to tell wsjobd what to do,
+         it can contain the following fields:
+        :param channel:
+        report_system_load: a boolean to indicate whether to report system load, if set to true and the progress info
+        is a dict, then the system load info will be add to progress dict by key `system_load`, the value is also a dict
+        , which contains three fields: `mem_available`, `cpu_idle_percent`, `client_number`.
+        cpu_sample_interval: not used any more, system load is sampled by a shared background sampler, see
+        `run(load_sample_interval)`. It is still required to be a number if present.
+        :param msg:
+        check_load: a dict to enable system load check, also to set customed thresholds, the can contain the following fields
+        ident : required. the identifier of a job, it is used to prevent from creating the same job repeatedly.
+        progress: a dict to set progress reporting related settings, it can contain the following fields:
+            - `interval`: the interval of progress reporting, default is 5 seconds
+        `key`: the sub field in which the progress info located
+            - `delta`: if set to true, send `{"snapshot": <progress>, "epoch": E, "version": N}` first and then only
+              the changed keys as json merge-patch `{"patch": {...}, "epoch": E, "version": N}`. The client can send
+              `{"cmd": "resync"}` to get a snapshot again.
+            - `max_rate`: the max number of frames per second sent when the job calls `job.update()` or
+              `job.report()`, the default is 10.
+            - `codec`: `"json"` by default, `"orjson"` for faster json encoding, or `"msgpack"` for binary
+              MessagePack frames if `msgpack` is installed.
+            - `compress`: `true` or a number of bytes, a frame larger than it, 1024 if `true`, is compressed with
+              zlib and sent as a binary frame. A compressed frame of a binary codec such as `"msgpack"` starts with
+              the byte `0xc1`, which never starts a MessagePack frame. Error frames are always json text frames.
+        When the job ends, the last progress is sent at once, followed by a terminal frame, see
+        `ProgressPublisher.terminal_frame`, and then the connection is closed.
+        :param func: required. the function of job, it contain module name and function name, seperated by a dot,
+        the module shoud in the `jobs` directory.
+        process: a boolean, if set to true, run the job function in the process pool, see `process_job`.
+        trace: a boolean, if set to true and wsjobd runs with `trace_file`, where time goes for this request is
+        recorded, see `RequestTracer`.
+        since_version: the last `version` of delta frames a reconnecting client has, it implies `progress.delta`.
+        since_epoch: required with `since_version`, the `epoch` of the same frame. Only the changes since then are
+        sent as one patch, or a snapshot if the epoch differs or the version is too old, see `DeltaState`.
+        priority: an integer from 1 to `MAX_PRIORITY`, the default is 1. When all job workers are busy, a job of priority 2 is
+        scheduled as twice often as a job of priority 1 of another tenant, see `JobExecutor`. The tenant of a job is
+        determined by `AdmissionPolicy.tenant`.
+        If the function is defined with `async def`, it runs on a shared asyncio loop, see `CoroutineJobRunner`.
+        :param jobs_dir: the jobs dir `func` is found in, it is recorded to resume the job, see `JobJournal`.
+        :param journal: the records of the journal to resume the job from.
+        A job can be cancelled by a client with `{"cmd": "cancel"}`, or by `OrphanReaper`, see `cancel`.
+        """
+        self.ident = msg["ident"]
+        self.channel = channel
+        self.data = msg
+        self.worker = func
+        self.func_name = msg.get("func")
+        self.jobs_dir = jobs_dir
+        # the state of the last `checkpoint()` if the job is resumed from the journal
+        self.restored = None
+        # the index of the worker running the job if it is a relay job, see `WorkerCluster`
+        self.owner = getattr(func, "wsjobd_owner", None)
+        self.priority = msg.get("priority", 1)
+        self.tenant = admission_policy.tenant(channel, msg)
+        self.queued_at = None
+        self.queue_key = None
+        self.started_at = None
+        self.trace = None
+        self.ctx = {}
+        self.err = None
+        self.status = JOB_QUEUED
+        self.thread = None
+        self.ended = threading.Event()
+        # set by `cancel()`, a job function should check it and return as soon as possible
+        self.cancelled = threading.Event()
+        # the asyncio task running a coroutine job
+        self.task = None
+        self.update_pending = False
+        self.subscriptions = []
+        # the number of relay jobs of other workers mirroring this job
+        self.relays = 0
+        # when the last subscriber has gone, `None` if the job has subscribers or never had one
+        self.orphaned_at = None
+        self.publisher = ProgressPublisher(self)
+        self.progress_available = _ProgressEvent(self)
+
+        if self.ident in self.sessions:
+            logger.info(
+                "job: %s already exists, created by chennel %s" % (self.ident, repr(self.sessions[self.ident].channel))
+            )
+            return
+        else:
+            if self.owner is None:
+                try:
+                    admission_policy.admit(channel, msg, force=journal is not None)
+                except Exception:
+                    # the claim is taken before the job is created, see `get_or_create_job`
+                    if worker_cluster.enabled():
+                        worker_cluster.release(self.ident)
+                    raise
+            self.sessions[self.ident] = self
+            logger.info(
+                ("inserted job: %s to sessions by channel %s, " + "there are %d jobs in sessions now")
+                % (self.ident, repr(self.channel), len(self.sessions))
+            )
+
+        job_journal.open(self, journal)
+        self.queued_at = time.monotonic()
+
+        if inspect.iscoroutinefunction(self.worker):
+            coroutine_job_runner.submit(self)
+            return
+
+        try:
+            job_executor.submit(self, force=journal is not None)
+        except Exception:
+            # not only rejected, a job left in sessions but never run would block its ident for ever
+            with self.lock:
+                del self.sessions[self.ident]
+            self._release()
+            raise
+
+    def work(self):
+        logger.info("job %s started, the data is: %s" % (self.ident, self.data))
+        self.started_at = time.monotonic()
+        self._trace_started()
+
+        try:
+            # cancelled while queued
+            if not self.cancelled.is_set():
+                job_journal.sync(self)
+                self.worker(self)
+        except Exception as e:
+            logger.exception("job %s got exception: %s" % (self.ident, repr(e)))
+            self.err = e
+        finally:
+            self._end()
+
+    async def work_async(self):
+        logger.info("job %s started, the data is: %s" % (self.ident, self.data))
+        self.started_at = time.monotonic()
+        self._trace_started()
+
+        try:
+            if not self.cancelled.is_set():
+                if job_journal.enabled():
+                    await asyncio.get_running_loop().run_in_executor(None, job_journal.sync, self)
+                await self.worker(self)
+        except asyncio.CancelledError:
+            logger.info("job %s is stopped by cancel" % self.ident)
+        except Exception as e:
+            logger.exception("job %s got exception: %s" % (self.ident, repr(e)))
+            self.err = e
+        finally:
+            self._end()
+
+    def _trace_started(self):
+        trace = self.trace
+        if trace is not None:
+            trace.add("thread_start", self.queued_at, self.started_at, self.ident)
+
+    def report(self, **fields):
+        """
+        Update `job.data` with `fields` and notify the subscribers, see `update`.
+        """
+        self.data.update(fields)
+        self.update()
+
+    def update(self):
+        """
+        Tell wsjobd that `job.data` has changed. Every subscriber is sent the progress as soon as its max frame rate
+        allows, instead of at its next `interval`. Updates between two frames are coalesced, thus it is cheap to call
+        it frequently.
+        """
+        if self.update_pending:
+            return
+
+        self.update_pending = True
+        progress_scheduler.wake(self)
+
+    def cancel(self, reason="client"):
+        """
+        Ask the job to stop, it does nothing if the job has ended or is cancelled.
+
+        A job function is not interrupted, except a coroutine job, in which `asyncio.CancelledError` is raised at
+        its current `await`. A job function should check `job.cancelled.is_set()` and return. A queued job does not
+        run at all. The job ends with the terminal frame `{"status": "cancelled"}`, and it is not put in the result
+        cache. The job a relay job of `WorkerCluster` mirrors is not stopped.
+        """
+        with self.lock:
+            if self.ended.is_set() or self.cancelled.is_set():
+                return
+            self.cancelled.set()
+
+        logger.info("job %s is cancelled, reason: %s" % (self.ident, reason))
+        metrics.inc("wsjobd_jobs_cancelled_total", (("reason", reason),))
+
+        if inspect.iscoroutinefunction(self.worker):
+            coroutine_job_runner.cancel(self)
+        else:
+            process_job_pool.cancel(self)
+
+    def attach(self, sub):
+        """
+        Add a subscription, the caller must hold `Job.lock`.
+        """
+        self.subscriptions.append(sub)
+        self.orphaned_at = None
+
+    def detach(self, sub):
+        """
+        Remove a subscription, the job is orphaned if it is the last subscriber, see `OrphanReaper`. The caller must
+        hold `Job.lock`.
+        """
+        if sub not in self.subscriptions:
+            return
+
+        self.subscriptions.remove(sub)
+        self._check_orphaned()
+
+    def attach_relay(self):
+        """
+        Count a relay job of another worker mirroring this job as a subscriber, see `WorkerCluster`.
+        """
+        with self.lock:
+            self.relays += 1
+            self.orphaned_at = None
+
+    def detach_relay(self):
+        with self.lock:
+            self.relays -= 1
+            self._check_orphaned()
+
+    def subscribers(self):
+        """
+        The number of subscriptions and relay jobs of other workers.
+        """
+        return len(self.subscriptions) + self.relays
+
+    def _check_orphaned(self):
+        if self.subscribers() == 0 and not self.ended.is_set():
+            self.orphaned_at = time.monotonic()
+
+    def checkpoint(self, state=None):
+        """
+        Write `job.data` and `state` to the journal at once. If wsjobd restarts before the job ends, the job is run
+        again with this `job.data` and `job.restored` set to `state`, see `JobJournal`. `state` must be json
+        serializable. It does nothing if the journal is disabled. It is not available in a process job.
+        """
+        job_journal.write(self, "checkpoint", state)
+
+    def _end(self):
+        logger.info("job %s ended" % self.ident)
+        metrics.observe("wsjobd_job_duration_seconds", time.monotonic() - self.started_at, (("func", self.func_name),))
+        # release the claim before it leaves sessions, a new job of the same ident is never left unclaimed
+        self._release()
+        self.close()
+        self.status = JOB_DONE
+        self.ended.set()
+
+        # send the final progress and the terminal frame at once
+        progress_scheduler.wake(self)
+
+    def _release(self):
+        if self.owner is not None:
+            return
+
+        admission_policy.release(self)
+        job_journal.close(self)
+        if worker_cluster.enabled():
+            worker_cluster.release(self.ident)
+
+    def close(self):
+        with self.lock:
+            # cache it before it leaves sessions, thus there is no moment a new request could not find it
+            if not self.cancelled.is_set():
+                job_result_cache.put(self)
+            del self.sessions[self.ident]
+            logger.info(
+                ("removed job: %s from sessions, there are %d " + "jobs in sessions now")
+                % (self.ident, len(self.sessions))
+            )
+
+
+def get_or_create_job(channel, msg, func, jobs_dir=JOBS_DIR):
+    with Job.lock:
+        if msg["ident"] not in Job.sessions:
+            job = job_result_cache.get(msg["ident"])
+            if job is not None:
+                logger.info("job: %s found in result cache" % msg["ident"])
+                return job
+
+            if worker_cluster.enabled():
+                owner = worker_cluster.claim(msg["ident"])
+                if owner is not None:
+                    logger.info("job: %s is running in worker %d, relay it" % (msg["ident"], owner))
+                    func = worker_cluster.relay(owner)
+
+        Job(channel, msg, func, jobs_dir=jobs_dir)
+
+        job = Job.sessions.get(msg["ident"])
+
+    return job
+
+
+class _ProgressEvent(threading.Event):
+    """
+    Setting it is the same as `job.update()`, it is kept for compatibility.
+    """
+
+    def __init__(self, job):
+        super(_ProgressEvent, self).__init__()
+        self.job = job
+
+    def set(self):
+        super(_ProgressEvent, self).set()
+        self.job.update()
+
+
+class DeltaState(object):
+    """
+    The last progress value of one `progress.key` sent in delta mode, and the merge-patch that leads to it.
+
+    A dict value is diffed by its top level keys, each of them is compared by its encoded json. Any other value is
+    replaced as a whole, as a merge-patch does.
+
+    Every change of the value increments `version`. The merge-patches of the last `history_size` versions are kept,
+    thus a client that has an older version is sent one merge-patch composed of them, see `patch_since`.
+
+    Versions restart from 0 in another `DeltaState`, e.g., of a job run again after a restart, thus a version is
+    meaningful only with the random `epoch` of the `DeltaState`.
+    """
+
+    history_size = 64
+
+    def __init__(self):
+        self.epoch = os.urandom(8).hex()
+        self.version = 0
+        self.encoded = None
+        self.patch = None
+        # (version, merge-patch to it) of the last versions
+        self.history = deque(maxlen=self.history_size)
+
+    def update(self, value):
+        if isinstance(value, dict):
+            encoded = dict((k, k3utfjson.dump(v)) for k, v in value.items())
+        else:
+            encoded = k3utfjson.dump(value)
+
+        if encoded == self.encoded:
+            return
+
+        if isinstance(encoded, dict) and isinstance(self.encoded, dict):
+            patch = dict((k, value[k]) for k, v in encoded.items() if self.encoded.get(k) != v)
+            for k in self.encoded:
+                if k not in encoded:
+                    patch[k] = None
+        else:
+            patch = value
+
+        self.version += 1
+        self.encoded = encoded
+        self.patch = patch
+        self.history.append((self.version, patch))
+
+    def patch_since(self, version):
+        """
+        The merge-patch from `version` to the current version, or `None` if `version` is evicted from the history
+        or unknown.
+        """
+        if version == self.version:
+            return {}
+
+        if version == self.version - 1:
+            return self.patch
+
+        if len(self.history) == 0 or not self.history[0][0] - 1 <= version < self.version:
+            return None
+
+        composed = {}
+        for v, patch in self.history:
+            if v <= version:
+                continue
+
+            # a dict patch changes only the keys in it, any other patch replaces the value as a whole
+            if not isinstance(patch, dict):
+                composed = patch
+            elif isinstance(composed, dict):
+                composed = dict(composed)
+                composed.update(patch)
+            else:
+                # a dict replacing a value as a whole can not be composed into a merge-patch of the older value
+                return None
+
+        return composed
+
+
+class ProgressPublisher(object):
+    """
+    Builds the progress frames of one job.
+
+    In every tick `job.data` is snapshotted once and a frame is encoded once for each distinct `progress.key`,
+    the same encoded frame is then sent to all subscriptions sharing that key.
+
+    A subscription in delta mode receives `{"snapshot": <progress>, "epoch": E, "version": N}` first, and then
+    `{"patch": <merge-patch>, "epoch": E, "version": N}` frames with only the changed keys. A subscription with a
+    `since_epoch` and `since_version` receives a patch from that version if the epoch is the same and the version is
+    still in the history of `DeltaState`, or a snapshot otherwise.
+
+    Frames are encoded by the codec of a subscription, and cached per codec.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.idents = {}
+        self.snapshot = None
+        self.system_load = None
+        self.frames = {}
+        self.deltas = {}
+        self.updated = set()
+        self.ended = False
+
+    def begin(self):
+        # check it before snapshot, thus the last frame has the final data
+        self.ended = self.job.ended.is_set()
+
+        data = self.job.data
+        if isinstance(data, dict):
+            data = dict(data)
+
+        self.snapshot = data
+        self.system_load = None
+        self.frames = {}
+        self.updated = set()
+
+    def frame(self, sub):
+        if not self.ended and self.job.status == JOB_QUEUED:
+            return self._queued_frame(sub.codec)
+
+        if sub.delta:
+            return self._delta_frame(sub)
+
+        frame_key = (sub.codec.name, sub.key, sub.report_system_load)
+
+        if frame_key not in self.frames:
+            to_send = self._progress(sub.key)
+
+            if sub.report_system_load and isinstance(to_send, dict):
+                to_send = dict(to_send)
+                to_send["system_load"] = self._system_load(sub.channel)
+
+            self.frames[frame_key] = _encode(to_send, sub.codec)
+
+        return self.frames[frame_key]
+
+    def _delta_frame(self, sub):
+        key = sub.key
+        delta = self.deltas.get(key)
+        if delta is None:
+            delta = self.deltas[key] = DeltaState()
+
+        value = self._progress(key)
+
+        if key not in self.updated:
+            delta.update(value)
+            self.updated.add(key)
+
+        patch = None
+        if sub.version is not None and sub.epoch == delta.epoch:
+            patch = delta.patch_since(sub.version)
+
+        if patch is None:
+            kind, to_send = "snapshot", {"snapshot": value}
+        else:
+            kind, to_send = ("patch", sub.version), {"patch": patch}
+
+        to_send["epoch"] = delta.epoch
+        to_send["version"] = delta.version
+        sub.epoch = delta.epoch
+        sub.version = delta.version
+
+        frame_key = (sub.codec.name, key, sub.report_system_load, kind)
+
+        if frame_key not in self.frames:
+            if sub.report_system_load and isinstance(value, dict):
+                to_send["system_load"] = self._system_load(sub.channel)
+
+            self.frames[frame_key] = _encode(to_send, sub.codec)
+
+        return self.frames[frame_key]
+
+    def terminal_frame(self, codec):
+        """
+        The frame sent after the last progress frame of an ended job: `{"status": "done"}`,
+        `{"status": "cancelled"}` if the job is cancelled, or
+        `{"status": "error", "err": <exception class name>, "val": <exception args>}` if the job raised.
+        """
+        frame_key = ("terminal", codec.name)
+
+        if frame_key not in self.frames:
+            err = self.job.err
+            if self.job.cancelled.is_set():
+                to_send = {"status": JOB_CANCELLED}
+            elif err is None:
+                to_send = {"status": JOB_DONE}
+            else:
+                name = err.name if isinstance(err, RemoteJobError) else err.__class__.__name__
+                to_send = {"status": "error", "err": name, "val": err.args}
+
+            try:
+                frame = codec.dumps(to_send)
+            except (TypeError, ValueError):
+                to_send["val"] = [repr(a) for a in err.args]
+                frame = codec.dumps(to_send)
+
+            self.frames[frame_key] = frame
+
+        return self.frames[frame_key]
+
+    def ident(self, codec):
+        """
+        The encoded ident of the job.
+        """
+        encoded = self.idents.get(codec.name)
+        if encoded is None:
+            encoded = self.idents[codec.name] = codec.dumps(self.job.ident)
+        return encoded
+
+    def compress(self, frame):
+        """
+        Compress a frame with zlib, a frame shared by many subscriptions is compressed once in a tick. A binary frame
+        is prefixed with `COMPRESSED_MARKER`, or it could not be told from an uncompressed one.
+        """
+        frame_key = ("zlib", frame)
+
+        if frame_key not in self.frames:
+            if isinstance(frame, str):
+                self.frames[frame_key] = zlib.compress(frame.encode("utf-8"), 1)
+            else:
+                self.frames[frame_key] = COMPRESSED_MARKER + zlib.compress(frame, 1)
+
+        return self.frames[frame_key]
+
+    def _queued_frame(self, codec):
+        frame_key = (JOB_QUEUED, codec.name)
+
+        if frame_key not in self.frames:
+            position = job_executor.position(self.job)
+            self.frames[frame_key] = codec.dumps({"status": JOB_QUEUED, "position": position})
+
+        return self.frames[frame_key]
+
+    def _progress(self, key):
+        if key is None:
+            return self.snapshot
+        return self.snapshot.get(key)
+
+    def _system_load(self, channel):
+        if self.system_load is None:
+            self.system_load = channel.get_system_load()
+
+        return self.system_load
+
+
+class ProgressSubscription(object):
+    """
+    One progress stream: the progress of `job` reported to `channel` every `interval` seconds.
+    `key` is the sub field of `job.data` in which the progress info located, `None` means the entire `job.data`.
+    If `delta` is true, only the changes since the last frame are sent, see `ProgressPublisher`.
+    `max_rate` is the max number of frames per second sent on `job.update()`, `None` means the default of the
+    scheduler.
+    If `report_system_load` is true, the system load is added to a dict progress by key `system_load`.
+    `codec` is the name of a codec in `CODECS` to encode frames. If `compress` is not `None`, a frame of at least
+    `compress` bytes is compressed with zlib and sent as a binary frame, see `ProgressPublisher.compress`.
+    `since_epoch` and `since_version` are the epoch and version of the progress the client already has in delta
+    mode.
+    """
+
+    def __init__(
+        self,
+        job,
+        channel,
+        interval=5,
+        key=None,
+        delta=False,
+        max_rate=None,
+        report_system_load=False,
+        codec="json",
+        compress=None,
+        since_epoch=None,
+        since_version=None,
+    ):
+        self.job = job
+        self.jobs = [job]
+        self.ident = job.ident
+        self.codec = CODECS[codec]
+        self.compress = compress
+        self.ident_encoded = job.publisher.ident(self.codec)
+        self.channel = channel
+        self.interval = interval
+        self.key = key
+        self.delta = delta
+        self.max_rate = max_rate
+        self.report_system_load = report_system_load
+        self.last_sent = None
+        # the `RequestTrace` waiting for the first frame
+        self.trace = None
+
+        # the version of the progress the client has, `None` means the client needs a full snapshot
+        self.version = since_version
+        # the `DeltaState.epoch` of `version`
+        self.epoch = since_epoch
+
+        self.deadline = None
+        self.closed = False
+
+    def tick(self):
+        channel = self.channel
+        outbox = channel.outbox
+
+        try:
+            ended = all(job.publisher.ended for job in self.jobs)
+
+            if self.delta and outbox.pending(self):
+                if not ended:
+                    # the client lags, the pending patch is still valid
+                    return
+                # the final frame must replace the pending one, a patch can not
+                self.version = None
+
+            frame = self.frame()
+
+            # called for every subscription in every tick, do not format the frame
+            logger.debug("job %s on channel %s send progress", self.ident, channel)
+
+            outbox.put(self._pack(frame), key=self, trace=self.trace)
+            self.trace = None
+            self.last_sent = time.monotonic()
+
+            if ended:
+                logger.info("job %s ended" % self.ident)
+                # a multiplexed connection carries other jobs
+                outbox.put(self._pack(self.terminal_frame()), close=not channel.multiplex)
+                self.close()
+
+        except Exception as e:
+            self.close()
+            logger.exception("got exception when sending progress on channel %s: %s" % (repr(channel), repr(e)))
+            channel.ws.close()
+
+    def frame(self):
+        self.job.progress_available.clear()
+        return self.job.publisher.frame(self)
+
+    def terminal_frame(self):
+        return self.job.publisher.terminal_frame(self.codec)
+
+    def ended(self):
+        return all(job.ended.is_set() for job in self.jobs)
+
+    def resync(self):
+        self.version = None
+        progress_scheduler.wake_subscription(self)
+
+    def close(self):
+        self.closed = True
+        with Job.lock:
+            for job in self.jobs:
+                job.detach(self)
+
+            if self in self.channel.subscriptions:
+                self.channel.subscriptions.remove(self)
+
+    def _pack(self, frame):
+        if self.channel.multiplex:
+            # the frame is already encoded and shared with other subscriptions, do not encode it again
+            codec = self.codec
+            frame = codec.map([(codec.key("ident"), self.ident_encoded), (codec.key("frame"), frame)])
+
+        if self.compress is not None:
+            size = len(frame)
+            # a text frame has at most 4 bytes per character, it is encoded only if it might reach the threshold
+            if isinstance(frame, str) and size < self.compress <= size * 4:
+                size = len(frame.encode("utf-8"))
+
+            if size >= self.compress:
+                frame = self.job.publisher.compress(frame)
+
+        return frame
+
+
+class BatchSubscription(ProgressSubscription):
+    """
+    The progress of a batch of jobs reported in one frame: `{"batch": {<ident>: <progress>, ...}}`, with
+    `system_load` at top level if `report_system_load` is true. The progress of every job is the same frame a
+    single job subscription gets, thus it is shared with other subscriptions.
+
+    When all of the jobs end, the terminal frame is `{"status": "done", "batch": {<ident>: <terminal frame>, ...}}`.
+    Delta mode is not supported. `ident` is an optional name of the batch, used to tag frames in multiplex mode.
+    """
+
+    def __init__(
+        self,
+        jobs,
+        channel,
+        interval=5,
+        key=None,
+        max_rate=None,
+        report_system_load=False,
+        ident=None,
+        codec="json",
+        compress=None,
+    ):
+        super(BatchSubscription, self).__init__(
+            jobs[0], channel, interval, key, max_rate=max_rate, codec=codec, compress=compress
+        )
+        self.jobs = jobs
+        self.ident = ident
+        self.ident_encoded = self.codec.dumps(ident)
+        self.batch_system_load = report_system_load
+
+    def frame(self):
+        codec = self.codec
+        frames = [(job.publisher.ident(codec), job.publisher.frame(self)) for job in self.jobs]
+
+        items = [(codec.key("batch"), codec.map(frames))]
+        if self.batch_system_load:
+            items.append((codec.key("system_load"), codec.dumps(self.channel.get_system_load())))
+
+        return codec.map(items)
+
+    def terminal_frame(self):
+        codec = self.codec
+        frames = [(job.publisher.ident(codec), job.publisher.terminal_frame(codec)) for job in self.jobs]
+        return codec.map([(codec.key("status"), codec.key(JOB_DONE)), (codec.key("batch"), codec.map(frames))])
+
+
+class ChannelOutbox(object):
+    """
+    The frames waiting to be sent to a channel, they are sent by a greenlet of the channel, so that a slow client
+    does not block the scheduler or other clients.
+
+    A progress frame replaces the pending frame of the same subscription, thus a lagging client gets only the
+    latest progress. Other frames, such as terminal frames, are never dropped. A client that has not taken a frame
+    in `deadline` seconds, or has more than `max_size` frames pending, is disconnected.
+    """
+
+    deadline = 30
+    max_size = 1024
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.frames = OrderedDict()
+        self.seq = itertools.count()
+        self.wakeup = None
+        self.greenlet = None
+        self.closed = False
+
+    def put(self, frame, key=None, close=False, trace=None):
+        """
+        Queue a frame to send, it must be called in the gevent hub of the server.
+        If `key` is not `None`, the frame replaces a pending frame with the same `key`.
+        If `close` is true, the connection is closed after the frame is sent.
+        If `trace` is not `None`, the `first_send` span of it ends when the frame is sent.
+        """
+        if self.closed:
+            return
+
+        if key is None:
+            key = ("seq", next(self.seq))
+
+        replaced = self.frames.pop(key, None)
+        if replaced is not None and trace is None:
+            trace = replaced[3]
+
+        self.frames[key] = (frame, close, time.monotonic(), trace)
+
+        if len(self.frames) > self.max_size:
+            logger.info("channel %s has %d frames pending, disconnect it" % (repr(self.channel), len(self.frames)))
+            self._abort()
+            return
+
+        if self.greenlet is None:
+            self.wakeup = gevent.event.Event()
+            self.greenlet = gevent.spawn(self._run)
 
+        self.wakeup.set()
 
-class JobError(Exception):
-    pass
+    def pending(self, key):
+        return key in self.frames
 
+    def _run(self):
+        ws = self.channel.ws
 
-class InvalidMessageError(JobError):
-    pass
+        while not self.closed:
+            if len(self.frames) == 0:
+                self.wakeup.clear()
+                self.wakeup.wait()
+                continue
 
+            _, (frame, close, queued_at, trace) = self.frames.popitem(last=False)
 
-class InvalidProgressError(InvalidMessageError):
-    pass
+            try:
+                # `None` is a placeholder to close the connection after the frames before it
+                if frame is not None:
+                    with gevent.Timeout(self.deadline):
+                        ws.send(frame)
+
+                    metrics.observe("wsjobd_send_latency_seconds", time.monotonic() - queued_at)
+                    metrics.observe("wsjobd_frame_bytes", len(frame))
+
+                if trace is not None:
+                    trace.end("first_send")
+
+                if close:
+                    self.closed = True
+                    ws.close()
+
+            except gevent.Timeout:
+                logger.info("channel %s is stuck for %s seconds, disconnect it" % (repr(self.channel), self.deadline))
+                self._abort()
+
+            except WebSocketError as e:
+                self._close_subscriptions()
+                if ws.closed:
+                    logger.info("the client has closed the connection")
+                else:
+                    logger.exception(
+                        ("got websocket error when sending progress on" + " channel %s: %s")
+                        % (repr(self.channel), repr(e))
+                    )
+
+            except Exception as e:
+                self._close_subscriptions()
+                logger.exception(
+                    "got exception when sending progress on channel %s: %s" % (repr(self.channel), repr(e))
+                )
+                ws.close()
 
+    def _abort(self):
+        self._close_subscriptions()
 
-class LoadingError(JobError):
-    pass
+        ws = self.channel.ws
+        sock = getattr(getattr(ws, "handler", None), "socket", None)
 
+        # closing a websocket sends a close frame, which blocks on a stuck client
+        if sock is None:
+            ws.close()
+            return
 
-class JobNotInSessionError(JobError):
-    pass
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            logger.info("failed to shutdown socket of channel %s: %s" % (repr(self.channel), repr(e)))
 
+    def _close_subscriptions(self):
+        self.closed = True
+        self.frames.clear()
 
-class Job(object):
-    lock = threading.RLock()
-    sessions = {}
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+        with Job.lock:
+            subs = list(self.channel.subscriptions)
+
+        for sub in subs:
+            sub.close()
+
+
+class ProgressScheduler(object):
+    """
+    Drives the progress ticks of all subscriptions from a single greenlet in the gevent loop.
 
-    def __init__(self, channel, msg, func):
+    Subscriptions are kept in a heap ordered by their next deadline, so the cost of one tick does not grow with
+    the number of connected clients. `add` and `wake` can be called from any thread.
+
+    A woken subscription sends at once, unless it has sent a frame in the last `1 / max_rate` seconds. A
+    subscription with an `interval` less than `1 / max_rate` ticks every `1 / max_rate` seconds.
+    """
+
+    def __init__(self, max_rate=10):
+        self.max_rate = max_rate
+        self.lock = threading.Lock()
+        self.hub = None
+        self.wakeup = None
+        self.greenlet = None
+
+        self.heap = []
+        self.seq = itertools.count()
+
+        self.added = []
+        self.woken = []
+        self.woken_subs = []
+
+    def start(self):
         """
-        Job description is a string formatted in json, it is used to tell wsjobd what to do,
-         it can contain the following fields:
-        :param channel:
-        report_system_load: a boolean to indicate whether to report system load, if set to true and the progress info
-        is a dict, then the system load info will be add to progress dict by key `system_load`, the value is also a dict
-        , which contains three fields: `mem_available`, `cpu_idle_percent`, `client_number`.
-        cpu_sample_interval: set the interval used by psutil.cpu_times_percent, the default is 0.02
-        :param msg:
-        check_load: a dict to enable system load check, also to set customed thresholds, the can contain the following fields
-        ident : required. the identifier of a job, it is used to prevent from creating the same job repeatedly.
-        progress: a dict to set progress reporting related settings, it can contain the following fields:
-            - `interval`: the interval of progress reporting, default is 5 seconds
-        `key`: the sub field in which the progress info located
-        :param func: required. the function of job, it contain module name and function name, seperated by a dot,
-        the module shoud in the `jobs` directory.
+        Start the scheduling greenlet in the gevent hub of the calling thread, it does nothing if already started.
         """
-        self.ident = msg["ident"]
-        self.channel = channel
-        self.data = msg
-        self.worker = func
-        self.ctx = {}
-        self.err = None
-        self.progress_available = threading.Event()
+        with self.lock:
+            if self.hub is not None:
+                return
 
-        if self.ident in self.sessions:
-            logger.info(
-                "job: %s already exists, created by chennel %s" % (self.ident, repr(self.sessions[self.ident].channel))
-            )
-            return
-        else:
-            self.sessions[self.ident] = self
-            logger.info(
-                ("inserted job: %s to sessions by channel %s, " + "there are %d jobs in sessions now")
-                % (self.ident, repr(self.channel), len(self.sessions))
-            )
+            self.hub = gevent.get_hub()
+            self.wakeup = gevent.event.Event()
+            self.greenlet = gevent.spawn(self._loop)
 
-        self.thread = k3thread.start(target=self.work, args=(), daemon=True)
+    def add(self, sub):
+        with Job.lock:
+            for job in sub.jobs:
+                job.attach(sub)
 
-    def work(self):
-        logger.info("job %s started, the data is: %s" % (self.ident, self.data))
+        with self.lock:
+            self.added.append(sub)
 
-        try:
-            self.worker(self)
-        except Exception as e:
-            logger.exception("job %s got exception: %s" % (self.ident, repr(e)))
-            self.err = e
-        finally:
-            logger.info("job %s ended" % self.ident)
-            self.close()
+        self._notify()
 
-    def close(self):
+    def wake(self, job):
         with self.lock:
-            del self.sessions[self.ident]
-            logger.info(
-                ("removed job: %s from sessions, there are %d " + "jobs in sessions now")
-                % (self.ident, len(self.sessions))
-            )
+            self.woken.append(job)
 
+        self._notify()
 
-def get_or_create_job(channel, msg, func):
-    with Job.lock:
-        Job(channel, msg, func)
+    def wake_subscription(self, sub):
+        with self.lock:
+            self.woken_subs.append(sub)
 
-        job = Job.sessions.get(msg["ident"])
+        self._notify()
 
-    return job
+    def _notify(self):
+        if self.hub is None:
+            return
+        self.hub.loop.run_callback_threadsafe(self.wakeup.set)
+
+    def _schedule(self, sub, deadline):
+        sub.deadline = deadline
+        heapq.heappush(self.heap, (deadline, next(self.seq), sub))
 
+    def _drain(self, now):
+        with self.lock:
+            added, self.added = self.added, []
+            woken, self.woken = self.woken, []
+            woken_subs, self.woken_subs = self.woken_subs, []
 
-def progress_sender(job, channel, interval=5, stat=None):
-    stat = stat or (lambda data: data)
-    data = job.data
+        for sub in added:
+            self._schedule(sub, now)
 
-    i = 10
-    try:
+        for job in woken:
+            job.update_pending = False
+            with Job.lock:
+                woken_subs.extend(job.subscriptions)
+
+        for sub in woken_subs:
+            if sub.closed:
+                continue
+
+            deadline = now
+            # the final frame of an ended job is never delayed
+            if sub.last_sent is not None and not sub.ended():
+                deadline = max(now, sub.last_sent + 1.0 / (sub.max_rate or self.max_rate))
+
+            if sub.deadline is None or sub.deadline > deadline:
+                self._schedule(sub, deadline)
+
+    def _loop(self):
         while True:
-            # if thread died due to some reason, still send 10 stats
-            if not job.thread.is_alive():
-                logger.info("job %s died: %s" % (job.ident, repr(job.err)))
-                if i == 0:
-                    channel.ws.close()
-                    break
-                i -= 1
+            self.wakeup.clear()
+            now = time.monotonic()
+            self._drain(now)
 
-            logger.info("jod %s on channel %s send progress: %s" % (job.ident, repr(channel), repr(stat(data))))
+            due = []
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                deadline, _, sub = heapq.heappop(self.heap)
 
-            to_send = stat(data)
-            if channel.report_system_load and isinstance(to_send, dict):
-                to_send["system_load"] = channel.get_system_load()
+                # an entry left by rescheduling, the subscription has a newer one in heap
+                if sub.closed or deadline != sub.deadline:
+                    continue
 
-            channel.ws.send(k3utfjson.dump(to_send))
+                due.append(sub)
 
-            if job.progress_available.wait(interval):
-                job.progress_available.clear()
+            # subscriptions of the same job due in this round share one snapshot
+            begun = set()
+            for sub in due:
+                for job in sub.jobs:
+                    if id(job) not in begun:
+                        begun.add(id(job))
+                        try:
+                            job.publisher.begin()
+                        except Exception as e:
+                            logger.exception("failed to snapshot job %s: %s" % (job.ident, repr(e)))
+
+            for sub in due:
+                # a broken subscription must not stop progress of all the others
+                try:
+                    sub.tick()
+
+                    if not sub.closed:
+                        interval = max(sub.interval, 1.0 / (sub.max_rate or self.max_rate))
+                        self._schedule(sub, time.monotonic() + interval)
+
+                except Exception as e:
+                    logger.exception("failed to tick subscription of job %s: %s" % (sub.ident, repr(e)))
+                    sub.close()
+
+            if len(self.heap) > 0:
+                timeout = max(self.heap[0][0] - time.monotonic(), 0)
+            else:
+                timeout = None
+
+            self.wakeup.wait(timeout)
 
-    except WebSocketError as e:
-        if channel.ws.closed:
-            logger.info("the client has closed the connection")
-        else:
-            logger.exception(
-                ("got websocket error when sending progress on" + " channel %s: %s") % (repr(channel), repr(e))
-            )
 
-    except Exception as e:
-        logger.exception("got exception when sending progress on channel %s: %s" % (repr(channel), repr(e)))
-        channel.ws.close()
+progress_scheduler = ProgressScheduler()
 
 
 class JobdWebSocketApplication(WebSocketApplication):
+    """
+    By default a connection carries one job: the first message is a job description, see `Job`.
+
+    If the first message is `{"multiplex": true}`, the connection is in multiplex mode and can carry many jobs. No
+    reply is sent to it. Every message after it is a command:
+
+    - `{"cmd": "submit", ...}`: the rest of the fields are the same as a job description.
+    - `{"cmd": "subscribe", "ident": ..., "progress": {...}, "report_system_load": ...}`: subscribe to the progress
+      of a running or cached job, without creating it.
+    - `{"cmd": "unsubscribe", "ident": ...}`: stop receiving progress of a job.
+    - `{"cmd": "resync", "ident": ...}`: get a full snapshot of a job in delta mode, all jobs if no `ident`.
+    - `{"cmd": "cancel", "ident": ...}`: cancel a job, or all jobs of a batch subscription, see `Job.cancel`.
+
+    A job description can also be a batch: `{"batch": [<job description>, ...], ...}`. The load check and the
+    function lookup are done once for the entire batch, and the progress of all jobs are sent in one frame, see
+    `BatchSubscription`. `check_load`, `progress`, `report_system_load` and `jobs_dir` are read from the batch
+    message, a job description can have its own `jobs_dir`. In multiplex mode a batch is submitted with
+    `{"cmd": "submit", "batch": [...]}`, and an optional `ident` names the batch. The admission limits and the job
+    queue are checked for all new jobs of a batch at once, if any of them would be rejected, no job is created and
+    the batch fails with the error.
+
+    Every frame sent is tagged with the ident it belongs to: `{"ident": ..., "frame": <the frame>}`, including
+    errors. The connection is not closed when a job ends.
+    `submit` and `subscribe` are handled by the `k3jobq` threads like a job description, the other commands are
+    handled at once, thus an `unsubscribe` that arrives before the `subscribe` is handled does nothing.
+    """
+
     jobq_mgr = None
 
     def on_open(self):
         logger.info("on open, the channel is: " + repr(self))
         self.ignore_message = False
-
-    def _parse_request(self, message):
+        self.multiplex = False
+        self.subscriptions = []
+        self.proxies = []
+        self.outbox = ChannelOutbox(self)
+        progress_scheduler.start()
+
+    def _parse_request(self, message, received_at):
+        trace = None
         try:
+            parse_start = time.monotonic()
             try:
                 msg = k3utfjson.load(message)
             except Exception:
                 raise InvalidMessageError("message is not a vaild json string: %s" % message)
 
-            self._check_msg(msg)
-
-            self.report_system_load = msg.get("report_system_load") is True
-            self.cpu_sample_interval = msg.get("cpu_sample_interval", 0.02)
-
-            if not isinstance(self.cpu_sample_interval, (int, float)):
-                raise InvalidMessageError("cpu_sample_interval is not a number")
+            trace = request_tracer.begin(msg, received_at)
+            if trace is not None:
+                trace.add("jobq", received_at, parse_start)
+                trace.add("parse", parse_start, time.monotonic())
 
-            check_load = msg.get("check_load")
-            if isinstance(check_load, dict):
-                self._check_system_load(check_load)
-
-            self.jobs_dir = msg.get("jobs_dir", JOBS_DIR)
-
-            self._setup_response(msg)
+            self._submit(msg, trace)
             return
 
         except SystemOverloadError as e:
@@ -231,32 +2907,335 @@ class JobdWebSocketApplication(WebSocketApplication):
             logger.exception(("exception on channel %s while handling " + "message, %s") % (repr(self), repr(e)))
             self._send_err_and_close(e)
 
+        finally:
+            if trace is not None:
+                trace.close()
+
+    def _parse_multiplex_request(self, msg, received_at):
+        ident = msg.get("ident")
+
+        trace = request_tracer.begin(msg, received_at)
+        if trace is not None:
+            trace.add("jobq", received_at, time.monotonic())
+
+        try:
+            if msg["cmd"] == "submit":
+                self._submit(msg, trace)
+            else:
+                self._subscribe(msg, trace)
+
+        except SystemOverloadError as e:
+            logger.info("system overload on chennel %s, %s" % (repr(self), repr(e)))
+            self._send_err(e, ident)
+
+        except JobError as e:
+            logger.info("error on channel %s while handling message, %s" % (repr(self), repr(e)))
+            self._send_err(e, ident)
+
+        except Exception as e:
+            logger.exception(("exception on channel %s while handling " + "message, %s") % (repr(self), repr(e)))
+            self._send_err(e, ident)
+
+        finally:
+            if trace is not None:
+                trace.close()
+
+    def _submit(self, msg, trace=None):
+        if isinstance(msg, dict) and "batch" in msg:
+            self._submit_batch(msg, trace)
+            return
+
+        self._check_msg(msg)
+
+        if self._route(msg):
+            return
+
+        report_system_load = msg.get("report_system_load") is True
+        cpu_sample_interval = msg.get("cpu_sample_interval", 0.02)
+
+        if not isinstance(cpu_sample_interval, (int, float)):
+            raise InvalidMessageError("cpu_sample_interval is not a number")
+
+        check_load = msg.get("check_load")
+        if isinstance(check_load, dict):
+            with _span(trace, "check_load"):
+                self._check_system_load(check_load)
+
+        jobs_dir = msg.get("jobs_dir", JOBS_DIR)
+
+        self._setup_response(msg, jobs_dir, report_system_load, trace)
+
+    def _submit_batch(self, msg, trace=None):
+        descs = msg["batch"]
+
+        if not isinstance(descs, list) or len(descs) == 0:
+            raise InvalidMessageError("batch is not a non-empty list")
+
+        for desc in descs:
+            self._check_msg(desc)
+
+        # a batch is not routed, a job owned by another node would run twice in the cluster
+        owners = [[desc["ident"], cluster_router.route(desc)] for desc in descs]
+        owners = [o for o in owners if o[1] is not None]
+        if len(owners) > 0:
+            raise RoutingError("jobs in batch are owned by other nodes", owners)
+
+        report_system_load = msg.get("report_system_load") is True
+
+        check_load = msg.get("check_load")
+        if isinstance(check_load, dict):
+            with _span(trace, "check_load"):
+                self._check_system_load(check_load)
+
+        jobs_dir = msg.get("jobs_dir", JOBS_DIR)
+
+        # look up every function once for the entire batch
+        funcs = {}
+        for desc in descs:
+            key = (desc.get("jobs_dir", jobs_dir), desc["func"])
+            if key not in funcs:
+                with _span(trace, "func_lookup", desc["func"]):
+                    funcs[key] = self._get_func(desc, key[0])
+
+        # reject invalid progress arguments before any job starts
+        progress = self._progress_args(msg)
+
+        jobs = OrderedDict()
+        # jobs created by this batch, not the existing ones it attaches to
+        created = []
+
+        # the batch fails as a whole before any job is created. Jobs are created with `Job.lock` held, thus the
+        # capacity checked is not taken by other requests in the meantime
+        with Job.lock:
+            new = OrderedDict()
+            for desc in descs:
+                if desc["ident"] not in Job.sessions and job_result_cache.get(desc["ident"]) is None:
+                    new.setdefault(desc["ident"], desc)
+
+            admission_policy.check(self, list(new.values()))
+
+            # a coroutine job is not run by `JobExecutor`
+            keys = [(desc.get("jobs_dir", jobs_dir), desc["func"]) for desc in new.values()]
+            job_executor.check(len([k for k in keys if not inspect.iscoroutinefunction(funcs[k])]))
+
+            try:
+                for desc in descs:
+                    func = funcs[(desc.get("jobs_dir", jobs_dir), desc["func"])]
+                    job = get_or_create_job(self, desc, func, desc.get("jobs_dir", jobs_dir))
+
+                    if job is None:
+                        raise JobNotInSessionError("job not in sessions: " + repr(desc["ident"]))
+
+                    if job.data is desc:
+                        created.append(job)
+                        if trace is not None:
+                            trace.watch_job(job)
+
+                    jobs[job.ident] = job
+
+            except Exception:
+                # unexpected, nobody would subscribe the jobs created so far
+                for job in created:
+                    job.cancel("rejected")
+                raise
+
+        if progress is None:
+            return
+
+        progress["report_system_load"] = report_system_load
+        progress.pop("delta")
+        progress.pop("since_epoch")
+        progress.pop("since_version")
+        sub = BatchSubscription(list(jobs.values()), self, ident=msg.get("ident"), **progress)
+        self._add_subscription(sub, trace)
+
+    def _subscribe(self, msg, trace=None):
+        ident = msg.get("ident")
+
+        if self._route(msg):
+            return
+
+        with Job.lock:
+            job = Job.sessions.get(ident) or job_result_cache.get(ident)
+
+            if job is None and worker_cluster.enabled():
+                owner = worker_cluster.owner(ident)
+                if owner is not None and owner != worker_cluster.index:
+                    Job(self, {"ident": ident}, worker_cluster.relay(owner))
+                    job = Job.sessions.get(ident)
+
+        if job is None:
+            raise JobNotInSessionError("job not in sessions: " + repr(ident))
+
+        self._subscribe_progress(job, self._progress_args(msg), msg.get("report_system_load") is True, trace)
+
     def on_message(self, message):
         logger.info("on message, the channel is: %s, the message is: %s" % (repr(self), message))
+        if self.multiplex:
+            self._on_multiplex_message(message)
+            return
+
         if self.ignore_message:
+            self._on_command(message)
             return
 
         else:
             self.ignore_message = True
 
-        self.jobq_mgr.put((self, message))
+        # parse it here only if it could be the hello of multiplex mode, a job description is parsed by jobq. A
+        # message of `None` or bytes is rejected by jobq
+        if isinstance(message, str) and '"multiplex"' in message:
+            try:
+                msg = k3utfjson.load(message)
+            except Exception:
+                msg = None
+
+            # a job description always has `ident` and `func`, it is never taken as the hello
+            if isinstance(msg, dict) and list(msg) == ["multiplex"] and msg["multiplex"] is True:
+                self.multiplex = True
+                return
+
+        self.jobq_mgr.put((self, message, time.monotonic()))
+
+    def _on_command(self, message):
+        # after the job message, a client can only send commands like `{"cmd": "resync"}`
+        try:
+            msg = k3utfjson.load(message)
+        except Exception:
+            logger.info("ignored invalid command on channel %s: %s" % (repr(self), message))
+            return
+
+        cmd = isinstance(msg, dict) and msg.get("cmd")
+
+        if cmd == "resync":
+            for sub in self.subscriptions:
+                sub.resync()
+            for proxy in self._find_proxies(None):
+                proxy.send(message)
+        elif cmd == "cancel":
+            self._cancel(None)
+            for proxy in self._find_proxies(None):
+                proxy.send(message)
+        else:
+            logger.info("ignored unknown command on channel %s: %s" % (repr(self), message))
+
+    def _on_multiplex_message(self, message):
+        try:
+            msg = k3utfjson.load(message)
+        except Exception:
+            self._send_err(InvalidMessageError("message is not a vaild json string: %s" % message), None)
+            return
+
+        if not isinstance(msg, dict) or "cmd" not in msg:
+            self._send_err(InvalidMessageError("'cmd' is not in message"), None)
+            return
+
+        self._on_multiplex_command(msg)
+
+    def _on_multiplex_command(self, msg):
+        cmd = msg["cmd"]
+        ident = msg.get("ident")
+
+        if cmd in ("submit", "subscribe"):
+            self.jobq_mgr.put((self, msg, time.monotonic()))
+
+        elif cmd == "unsubscribe":
+            for sub in self._find_subscriptions(ident):
+                sub.close()
+            for proxy in self._find_proxies(ident):
+                proxy.close()
+
+        elif cmd == "resync":
+            for sub in self._find_subscriptions(ident):
+                sub.resync()
+            for proxy in self._find_proxies(ident):
+                proxy.send(k3utfjson.dump(msg))
+
+        elif cmd == "cancel":
+            proxies = self._find_proxies(ident)
+            for proxy in proxies:
+                proxy.send(k3utfjson.dump(msg))
+
+            if not self._cancel(ident) and len(proxies) == 0:
+                self._send_err(JobNotInSessionError("job not in sessions: " + repr(ident)), ident)
+
+        else:
+            self._send_err(InvalidMessageError("unknown cmd: %s" % repr(cmd)), ident)
+
+    def _find_subscriptions(self, ident):
+        with Job.lock:
+            return [sub for sub in self.subscriptions if ident is None or sub.ident == ident]
+
+    def _cancel(self, ident):
+        # cancel the jobs subscribed with `ident`, or the job `ident` not subscribed by this channel
+        jobs = [job for sub in self._find_subscriptions(ident) for job in sub.jobs]
+
+        with Job.lock:
+            if len(jobs) == 0 and ident is not None and ident in Job.sessions:
+                jobs = [Job.sessions[ident]]
+
+        for job in jobs:
+            job.cancel()
+
+        return len(jobs) > 0
+
+    def _find_proxies(self, ident):
+        with Job.lock:
+            return [proxy for proxy in self.proxies if ident is None or proxy.ident == ident]
+
+    def _route(self, msg):
+        node = cluster_router.route(msg)
+        if node is None:
+            return False
+
+        ident = msg.get("ident")
+
+        if cluster_router.redirect:
+            logger.info("redirect job %s on channel %s to node %s" % (ident, repr(self), node))
+            frame = {"redirect": node}
+            if self.multiplex:
+                frame = {"ident": ident, "frame": frame}
+            self._send(k3utfjson.dump(frame))
+            return True
+
+        logger.info("proxy job %s on channel %s to node %s" % (ident, repr(self), node))
+        proxy = NodeProxy(self, node, msg)
+        with Job.lock:
+            self.proxies.append(proxy)
+        proxy.start()
+        return True
+
+    def _send_err(self, err, ident):
+        metrics.inc("wsjobd_errors_total", (("err", err.__class__.__name__),))
+        try:
+            err_msg = {
+                "err": err.__class__.__name__,
+                "val": err.args,
+            }
+            self._send(k3utfjson.dump({"ident": ident, "frame": err_msg}))
+        except Exception as e:
+            logger.error(("error on channel %s while sending back error " + "message, %s") % (repr(self), repr(e)))
 
     def _send_err_and_close(self, err):
+        metrics.inc("wsjobd_errors_total", (("err", err.__class__.__name__),))
         try:
             err_msg = {
                 "err": err.__class__.__name__,
                 "val": err.args,
             }
-            self.ws.send(k3utfjson.dump(err_msg))
+            self._send(k3utfjson.dump(err_msg))
         except Exception as e:
             logger.error(("error on channel %s while sending back error " + "message, %s") % (repr(self), repr(e)))
 
+    def _send(self, frame, close=False):
+        # all frames of a channel are sent by its outbox in the gevent hub, never by two threads at the same time
+        progress_scheduler.hub.loop.run_callback_threadsafe(self.outbox.put, frame, None, close)
+
     def get_system_load(self):
-        return {
-            MEM_AVAILABLE: psutil.virtual_memory().available,
-            CPU_IDLE_PERCENT: psutil.cpu_times_percent(self.cpu_sample_interval).idle,
-            CLIENT_NUMBER: len(self.protocol.server.clients),
-        }
+        system_load = system_load_sampler.get()
+        # counting clients is cheap, it is always up to date
+        system_load[CLIENT_NUMBER] = len(self.protocol.server.clients)
+        return system_load
 
     def _check_system_load(self, check_load):
         system_load = self.get_system_load()
@@ -289,67 +3268,358 @@ class JobdWebSocketApplication(WebSocketApplication):
         if "func" not in msg:
             raise InvalidMessageError("'func' is not in message")
 
-    def _setup_response(self, msg):
-        func = self._get_func_by_name(msg)
+        priority = msg.get("priority", 1)
+        # priority is a key of wait stats and a label of metrics, it must not be arbitrary
+        if isinstance(priority, bool) or not isinstance(priority, int) or not 1 <= priority <= MAX_PRIORITY:
+            raise InvalidMessageError("priority is not an integer from 1 to %d" % MAX_PRIORITY)
+
+        # the tenant is a key of token buckets and of the job queue
+        tenant_field = admission_policy.tenant_field
+        if tenant_field is not None and not isinstance(msg.get(tenant_field), (str, int, type(None))):
+            raise InvalidMessageError("%s is not a string" % tenant_field)
+
+    def _setup_response(self, msg, jobs_dir, report_system_load, trace=None):
+        # reject invalid progress arguments before the job starts
+        progress = self._progress_args(msg)
+
+        with _span(trace, "func_lookup", msg["func"]):
+            func = self._get_func(msg, jobs_dir)
+
         channel = self
-        job = get_or_create_job(channel, msg, func)
+        job = get_or_create_job(channel, msg, func, jobs_dir)
 
         if job is None:
             raise JobNotInSessionError("job not in sessions: " + repr(Job.sessions))
 
+        # not a job created by this request
+        if trace is not None and job.data is msg:
+            trace.watch_job(job)
+
+        self._subscribe_progress(job, progress, report_system_load, trace)
+
+    def _subscribe_progress(self, job, progress, report_system_load, trace=None):
+        if progress is None:
+            return
+
+        sub = ProgressSubscription(job, self, report_system_load=report_system_load, **progress)
+        self._add_subscription(sub, trace)
+
+    def _progress_args(self, msg):
         progress = msg.get("progress", {})
 
         if progress in (None, False):
-            return
+            return None
 
         if not isinstance(progress, dict):
             raise InvalidProgressError("the progress in message is not a dictionary")
 
         interval = progress.get("interval", 5)
-        progress_key = progress.get("key")
 
-        def get_progress(r):
-            if progress_key is None:
-                return r
-            return r.get(progress_key)
+        if not isinstance(interval, (int, float)) or isinstance(interval, bool) or interval <= 0:
+            raise InvalidProgressError("interval is not a positive number")
 
-        k3thread.start(target=progress_sender, args=(job, channel, interval, get_progress), daemon=True)
+        max_rate = progress.get("max_rate")
 
-    def _get_func_by_name(self, msg):
-        mod_func = self.jobs_dir.split("/") + msg["func"].split(".")
-        mod_path = ".".join(mod_func[:-1])
-        func_name = mod_func[-1]
+        if max_rate is not None and (not isinstance(max_rate, (int, float)) or max_rate <= 0):
+            raise InvalidProgressError("max_rate is not a positive number")
 
-        try:
-            mod = __import__(mod_path)
-        except (ImportError, SyntaxError) as e:
-            raise LoadingError("failed to import %s: %s" % (mod_path, repr(e)))
+        codec = progress.get("codec", "json")
+        if codec not in CODECS:
+            raise InvalidProgressError("codec is not supported: %s" % repr(codec))
 
-        for mod_name in mod_path.split(".")[1:]:
-            mod = getattr(mod, mod_name)
+        compress = progress.get("compress")
+        if compress is True:
+            compress = COMPRESS_THRESHOLD
+        elif compress is False:
+            compress = None
+        elif compress is not None and (not isinstance(compress, int) or compress < 0):
+            raise InvalidProgressError("compress is not a boolean or a non-negative integer")
 
-        logger.info("mod imported from: " + repr(mod.__file__))
+        since_version = msg.get("since_version")
+        if since_version is not None and (not isinstance(since_version, int) or isinstance(since_version, bool)):
+            raise InvalidMessageError("since_version is not an integer")
 
-        try:
-            func = getattr(mod, func_name)
-        except AttributeError:
-            raise LoadingError("function not found: " + repr(func_name))
+        since_epoch = msg.get("since_epoch")
+        if since_version is not None and not isinstance(since_epoch, str):
+            raise InvalidMessageError("since_epoch is not a string")
 
-        return func
+        return {
+            "interval": interval,
+            "key": progress.get("key"),
+            # resuming from a version implies delta mode
+            "delta": progress.get("delta") is True or since_version is not None,
+            "max_rate": max_rate,
+            "codec": codec,
+            "compress": compress,
+            "since_epoch": since_epoch,
+            "since_version": since_version,
+        }
+
+    def _add_subscription(self, sub, trace=None):
+        if trace is not None:
+            sub.trace = trace
+            trace.wait("first_send")
+
+        # subscribe again replaces the previous subscription of the same job
+        if sub.ident is not None:
+            for old in self._find_subscriptions(sub.ident):
+                old.close()
+
+        with Job.lock:
+            self.subscriptions.append(sub)
+
+        progress_scheduler.add(sub)
+
+    def _get_func(self, msg, jobs_dir):
+        return _process_func(msg, self._get_func_by_name(msg, jobs_dir))
+
+    def _get_func_by_name(self, msg, jobs_dir):
+        return job_registry.get(jobs_dir, msg["func"])
 
     def on_close(self, reason):
         logger.info("on close, the channel is: " + repr(self))
 
+        for sub in self._find_subscriptions(None):
+            sub.close()
 
-def _parse_request(args):
-    app, msg = args
-    app._parse_request(msg)
+        for proxy in self._find_proxies(None):
+            proxy.close()
 
 
-def run(ip="127.0.0.1", port=63482, jobq_thread_count=10):
-    JobdWebSocketApplication.jobq_mgr = k3jobq.JobManager([(_parse_request, jobq_thread_count)])
+def _process_func(msg, func):
+    if msg.get("process") is True or getattr(func, "wsjobd_process", False) is True:
+        func = functools.partial(process_job_pool.run, func)
+
+    return func
+
 
-    WebSocketServer(
-        (ip, port),
+def _parse_request(args):
+    app, msg, received_at = args
+
+    if app.multiplex:
+        app._parse_multiplex_request(msg, received_at)
+    else:
+        app._parse_request(msg, received_at)
+
+
+def run(
+    ip="127.0.0.1",
+    port=63482,
+    jobq_thread_count=10,
+    load_sample_interval=1,
+    preload_jobs_dirs=None,
+    job_max_workers=None,
+    job_queue_size=None,
+    process_pool_size=None,
+    progress_max_rate=10,
+    result_cache_size=0,
+    result_cache_ttl=60,
+    send_deadline=30,
+    admission=None,
+    metrics_port=None,
+    trace_file=None,
+    trace_format="jsonl",
+    trace_all=False,
+    workers=1,
+    cluster_nodes=None,
+    cluster_node=None,
+    cluster_redirect=False,
+    cluster_replicas=100,
+    journal_dir=None,
+    journal_interval=5,
+    orphan_grace=None,
+):
+    """
+    Start wsjobd and serve forever.
+
+    :param load_sample_interval: the interval in seconds to refresh the cached system load, which is used by
+    `report_system_load` and `check_load`.
+    :param preload_jobs_dirs: a list of jobs dirs, such as `[JOBS_DIR]`, every module in them is imported before
+    serving.
+    :param job_max_workers: the max number of jobs running at the same time, `None` means no limit.
+    :param job_queue_size: the max number of jobs waiting for a worker, `None` means no limit. A client whose job
+    is waiting receives `{"status": "queued", "position": N}` as progress.
+    :param process_pool_size: the number of processes to run process jobs, `None` means the number of cpus. A
+    process job also occupies a job worker while it runs.
+    :param progress_max_rate: the default max number of frames per second sent to a client when a job reports
+    progress with `job.update()` or `job.report()`.
+    :param result_cache_size: the max number of finished jobs to keep, a request for a kept job gets its final
+    result without running it again. 0 disables it.
+    :param result_cache_ttl: how long in seconds a finished job is kept.
+    :param send_deadline: a client that does not take a progress frame in this many seconds is disconnected.
+    :param admission: a dict of server side limits on new jobs, such as `{"max_jobs": 1000, "rate": 10}`, see
+    `AdmissionPolicy` for the keys.
+    :param metrics_port: if not `None`, serve `metrics` in the Prometheus text format at
+    `http://<ip>:<metrics_port>/metrics`.
+    :param trace_file: if not `None`, requests with `"trace": true` are traced and written to this file, see
+    `RequestTracer`.
+    :param trace_format: `"jsonl"` or `"chrome"`.
+    :param trace_all: trace every request.
+    :param workers: the number of worker processes accepting connections on `port`, see `WorkerCluster`. A dead
+    worker is restarted with a growing delay. With more than one worker, the result cache, system load and client
+    number are of each worker, a worker `i` serves metrics on `metrics_port + i`, and writes traces to
+    `<trace_file>.<i>`.
+    :param cluster_nodes: a list of `"host:port"` of all wsjobd nodes of a cluster, see `ClusterRouter`.
+    :param cluster_node: the `"host:port"` of this node in `cluster_nodes`, the default is `"<ip>:<port>"`.
+    :param cluster_redirect: reply a request for an ident owned by another node with a redirect frame, instead of
+    proxying it.
+    :param cluster_replicas: the number of points of every node on the hash ring.
+    :param journal_dir: if not `None`, running jobs are journaled in this dir and resumed after a restart, see
+    `JobJournal`. With more than one worker, a worker `i` uses `<journal_dir>/<i>`.
+    :param journal_interval: the interval in seconds to write snapshots of `job.data` to the journal.
+    :param orphan_grace: if not `None`, a job is cancelled when it has had no subscriber for this many seconds, see
+    `OrphanReaper`.
+    """
+    job_executor.max_workers = job_max_workers
+    job_executor.max_queue = job_queue_size
+    process_job_pool.max_workers = process_pool_size
+    progress_scheduler.max_rate = progress_max_rate
+    job_result_cache.size = result_cache_size
+    job_result_cache.ttl = result_cache_ttl
+    ChannelOutbox.deadline = send_deadline
+    job_journal.interval = journal_interval
+    orphan_reaper.grace = orphan_grace
+
+    for k, v in (admission or {}).items():
+        if k not in AdmissionPolicy.limits:
+            raise ValueError("unknown admission limit: %s" % k)
+
+        if k in ("max_jobs", "rate", "burst") and v is not None:
+            if not isinstance(v, (int, float)) or isinstance(v, bool) or v <= 0 or (k == "burst" and v < 1):
+                raise ValueError("admission limit %s is not a valid positive number: %r" % (k, v))
+
+        setattr(admission_policy, k, v)
+
+    if cluster_nodes is not None:
+        node = cluster_node or "%s:%d" % (ip, port)
+        cluster_router.configure(node, cluster_nodes, cluster_replicas, cluster_redirect)
+
+    serve = functools.partial(
+        _serve,
+        ip,
+        port,
+        jobq_thread_count,
+        load_sample_interval,
+        preload_jobs_dirs,
+        metrics_port,
+        (trace_file, trace_format, trace_all),
+        journal_dir,
+    )
+
+    if workers > 1:
+        _run_workers(workers, serve)
+    else:
+        serve()
+
+
+def _serve(ip, port, jobq_thread_count, load_sample_interval, preload_jobs_dirs, metrics_port, trace, journal_dir):
+    index = worker_cluster.index
+
+    trace_file, trace_format, trace_all = trace
+    if trace_file is not None:
+        if index is not None:
+            trace_file = "%s.%d" % (trace_file, index)
+        request_tracer.open(trace_file, trace_format, trace_all)
+
+    for jobs_dir in preload_jobs_dirs or []:
+        job_registry.preload(jobs_dir)
+
+    JobdWebSocketApplication.jobq_mgr = k3jobq.JobManager([(_parse_request, jobq_thread_count)])
+    system_load_sampler.start(load_sample_interval)
+    progress_scheduler.start()
+    orphan_reaper.start()
+
+    if journal_dir is not None:
+        if index is not None:
+            journal_dir = os.path.join(journal_dir, str(index))
+        job_journal.init(journal_dir)
+        job_journal.resume()
+
+    listener = (ip, port)
+    if index is not None:
+        listener = gevent.socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((ip, port))
+        listener.listen(256)
+
+        worker_cluster.serve()
+
+    server = WebSocketServer(
+        listener,
         Resource(OrderedDict({"/": JobdWebSocketApplication})),
-    ).serve_forever()
+    )
+
+    metrics.gauge("wsjobd_clients", "Number of connected clients.", lambda: len(server.clients))
+    metrics.gauge(
+        "wsjobd_jobq_depth",
+        "Number of messages waiting to be parsed.",
+        lambda: JobdWebSocketApplication.jobq_mgr.head_queue.qsize(),
+    )
+
+    if metrics_port is not None:
+        gevent.pywsgi.WSGIServer((ip, metrics_port + (index or 0)), metrics.wsgi_app, log=None).start()
+
+    server.serve_forever()
+
+
+def _run_workers(n, serve):
+    # fork before any thread is started
+    worker_cluster.init(tempfile.mkdtemp(prefix="wsjobd-"))
+    children = {}
+    # index -> [start time, number of deaths right after start]
+    starts = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            worker_cluster.index = index
+            try:
+                serve()
+            finally:
+                os._exit(1)
+
+        children[pid] = index
+        starts.setdefault(index, [0, 0])[0] = time.monotonic()
+        logger.info("started worker %d, pid: %d" % (index, pid))
+
+    def exit_(code):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        shutil.rmtree(worker_cluster.dir, ignore_errors=True)
+        os._exit(code)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit_(0))
+
+    for i in range(n):
+        spawn(i)
+
+    while True:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+
+        start = starts[index]
+        if time.monotonic() - start[0] < worker_cluster.min_uptime:
+            start[1] += 1
+        else:
+            start[1] = 0
+
+        if start[1] >= worker_cluster.max_quick_deaths:
+            logger.error(
+                "worker %d, pid: %d exited with status %d %d times in a row, stop" % (index, pid, status, start[1])
+            )
+            exit_(1)
+
+        delay = min(worker_cluster.restart_delay * 2 ** start[1], worker_cluster.max_restart_delay)
+        logger.error(
+            "worker %d, pid: %d exited with status %d, restart it in %.1f seconds" % (index, pid, status, delay)
+        )
+        time.sleep(delay)
+        spawn(index)